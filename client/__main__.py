@@ -6,9 +6,12 @@ from argparse import ArgumentParser
 from lib.client import Client
 
 
-def setup_logging():
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+
+def setup_logging(log_level):
     logging.basicConfig(stream=open('client.log', 'w'))
-    logging.getLogger().setLevel(logging.DEBUG)
+    logging.getLogger().setLevel(log_level)
     handlers = logging.getLogger().handlers
     if handlers:
         handlers[0].setFormatter(logging.Formatter("%(asctime)s\t%(levelname)s\t%(process)d\t%(thread)d\t%(message)s"))
@@ -19,14 +22,16 @@ def parse_args():
 
     parser.add_argument('--server_host', required=True)
     parser.add_argument('--server_port', type=int, default=8080)
+    parser.add_argument('--protocol', choices=('binary', 'base64'), default='binary')
+    parser.add_argument('--log_level', choices=LOG_LEVELS, default='INFO')
 
     return parser.parse_args()
 
 
 async def main():
-    setup_logging()
     args = parse_args()
-    await Client(args.server_host, args.server_port).handle_session()
+    setup_logging(args.log_level)
+    await Client(args.server_host, args.server_port, args.protocol).handle_session()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import logging
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+from lib.benchmark import Benchmark, DEFAULT_MIX
+
+
+SERVER_MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server', '__main__.py')
+SERVER_START_TIMEOUT = 30
+
+
+def setup_logging():
+    logging.basicConfig()
+    logging.getLogger().setLevel(logging.INFO)
+    handlers = logging.getLogger().handlers
+    if handlers:
+        handlers[0].setFormatter(logging.Formatter("%(asctime)s\t%(levelname)s\t%(process)d\t%(thread)d\t%(message)s"))
+
+
+def parse_args():
+    parser = ArgumentParser('SmallTwitter benchmark')
+
+    parser.add_argument('--server_host', default=None, help='Benchmark an already running server instead of starting a local one')
+    parser.add_argument('--server_port', type=int, default=8080)
+    parser.add_argument('--server_args', default='', help='Extra run_server arguments for the local server, e.g. "--handler_threads 16"')
+    parser.add_argument('--protocol', choices=('binary', 'base64'), default='binary')
+    parser.add_argument('--users', type=int, default=200, help='Number of users created before the load phase')
+    parser.add_argument('--clients', type=int, default=32, help='Number of concurrent client connections')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of the measured load phase')
+    parser.add_argument('--warmup', type=float, default=0, help='Seconds of load before measuring starts')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Comma separated request_type=weight pairs')
+    parser.add_argument('--avg_follows', type=int, default=20, help='Average number of users followed by each user')
+    parser.add_argument('--skew', type=float, default=1.0, help='Exponent of the follower distribution, higher means more followers for the most popular users')
+    parser.add_argument('--posts_per_user', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this path')
+
+    args = parser.parse_args()
+    if args.users < 2:
+        parser.error('--users should be at least 2')
+    return args
+
+
+def free_port(host):
+    with socket.socket() as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_server(process, host, port):
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise Exception('Server exited with code {}'.format(process.returncode))
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise Exception('Server did not start in {} seconds'.format(SERVER_START_TIMEOUT))
+
+
+async def run(args, host, port):
+    benchmark = Benchmark(
+        host,
+        port,
+        protocol=args.protocol,
+        users=args.users,
+        clients=args.clients,
+        duration=args.duration,
+        warmup=args.warmup,
+        mix=args.mix,
+        avg_follows=args.avg_follows,
+        skew=args.skew,
+        posts_per_user=args.posts_per_user,
+        seed=args.seed,
+    )
+    stats = await benchmark.run()
+
+    print(stats.report())
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(stats.summary(), f, indent=2)
+
+
+def main():
+    setup_logging()
+    args = parse_args()
+
+    if args.server_host is not None:
+        asyncio.run(run(args, args.server_host, args.server_port))
+        return
+
+    host = '127.0.0.1'
+    port = free_port(host)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'benchmark.db')
+        server_log_path = os.path.join(tmp_dir, 'server.log')
+        subprocess.run([sys.executable, SERVER_MAIN, 'init_db', '--db_path', db_path], check=True)
+
+        with open(server_log_path, 'w') as server_log:
+            process = subprocess.Popen(
+                [sys.executable, SERVER_MAIN, 'run_server', '--db_path', db_path, '--host', host, '--port', str(port)] + shlex.split(args.server_args),
+                stdout=server_log,
+                stderr=subprocess.STDOUT,
+            )
+            try:
+                asyncio.run(wait_for_server(process, host, port))
+                asyncio.run(run(args, host, port))
+            except Exception:
+                logging.error('Benchmark failed, server log tail:\n{}'.format(''.join(open(server_log_path).readlines()[-20:])))
+                raise
+            finally:
+                process.terminate()
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+import asyncio
+import bisect
+import collections
+import itertools
+import logging
+import random
+import time
+import uuid
+
+from lib.client import Client
+
+
+DEFAULT_MIX = 'get_user_feed=40,get_user_posts=20,post=15,like=15,follow=4,unfollow=2,signin=3,signup=1'
+POST_IDS_POOL_SIZE = 10000
+LIKE_ATTEMPTS = 10
+BUSY_RETRY_DELAY = 0.05
+PAGE_LIMIT = 20
+
+
+def parse_mix(mix):
+    res = []
+    for item in mix.split(','):
+        request_type, _, weight = item.strip().partition('=')
+        if request_type not in Benchmark.request_types:
+            raise ValueError('Unknown request type in mix: {}'.format(request_type))
+        res.append((request_type, float(weight or 1)))
+    if not res or sum(weight for _, weight in res) <= 0:
+        raise ValueError('Request mix is empty')
+    return res
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def make_follow_graph(rng, users, avg_follows, skew):
+    # Popularity follows a Zipf-like law: the user of rank i gets followers proportionally to 1 / (i + 1) ** skew
+    cum_weights = list(itertools.accumulate(1 / (i + 1) ** skew for i in range(users)))
+    total = cum_weights[-1]
+
+    graph = []
+    for follower in range(users):
+        count = min(users - 1, rng.randint(0, 2 * avg_follows))
+        followed = set()
+        while len(followed) < count:
+            user = bisect.bisect_left(cum_weights, rng.random() * total)
+            if user != follower and user < users:
+                followed.add(user)
+        graph.extend((user, follower) for user in followed)
+    return graph
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.started = None
+        self.finished = None
+
+    def add(self, request_type, latency, code):
+        self.latencies[request_type].append(latency)
+        if code != 200:
+            self.errors[request_type] += 1
+
+    def summary(self):
+        elapsed = (self.finished or time.perf_counter()) - (self.started or time.perf_counter())
+        res = {}
+        for request_type, latencies in sorted(self.latencies.items()) + [('total', sum(self.latencies.values(), []))]:
+            latencies = sorted(latencies)
+            res[request_type] = {
+                'count': len(latencies),
+                'errors': sum(self.errors.values()) if request_type == 'total' else self.errors[request_type],
+                'rps': len(latencies) / elapsed if elapsed > 0 else 0,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'max_ms': (latencies[-1] if latencies else 0) * 1000,
+            }
+        return {'elapsed': elapsed, 'requests': res}
+
+    def report(self):
+        summary = self.summary()
+        lines = ['Elapsed {:.1f}s'.format(summary['elapsed'])]
+        lines.append('{:<16}{:>9}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('type', 'count', 'errors', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+        for request_type, row in summary['requests'].items():
+            lines.append('{:<16}{count:>9}{errors:>8}{rps:>10.1f}{p50_ms:>10.2f}{p95_ms:>10.2f}{p99_ms:>10.2f}{max_ms:>10.2f}'.format(request_type, **row))
+        return '\n'.join(lines)
+
+
+class Benchmark:
+    request_types = ('signup', 'signin', 'post', 'follow', 'unfollow', 'like', 'get_user_posts', 'get_user_feed')
+
+    def __init__(self, server_host, server_port, protocol='binary', users=200, clients=32, duration=30, warmup=0,
+                 mix=DEFAULT_MIX, avg_follows=20, skew=1.0, posts_per_user=5, password='password', seed=None):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.protocol = protocol
+        self.users = users
+        self.clients = clients
+        self.duration = duration
+        self.warmup = warmup
+        self.mix = parse_mix(mix)
+        self.avg_follows = avg_follows
+        self.skew = skew
+        self.posts_per_user = posts_per_user
+        self.password = password
+
+        self.rng = random.Random(seed)
+        # Usernames are unique per run, so the benchmark can also target a server with existing data
+        self.prefix = 'bench_{}_'.format(uuid.uuid4().hex[:8])
+        self.new_users = itertools.count(users)
+
+        self.type_to_request = {
+            'signup': self.signup_request,
+            'signin': self.signin_request,
+            'post': self.post_request,
+            'follow': self.follow_request,
+            'unfollow': self.unfollow_request,
+            'like': self.like_request,
+            'get_user_posts': self.get_user_posts_request,
+            'get_user_feed': self.get_user_feed_request,
+        }
+
+        self.tokens = {}
+        self.signed_in = []
+        self.following = collections.defaultdict(set)
+        self.post_ids = []
+        # A post can be liked by a user only once, repeated likes would be counted as errors
+        self.liked = set()
+
+    def username(self, user):
+        return '{}{}'.format(self.prefix, user)
+
+    def auth(self, user):
+        return {'username': self.username(user), 'auth_token': self.tokens[user]}
+
+    def random_user(self):
+        return self.rng.choice(self.signed_in)
+
+    def add_post_ids(self, response):
+        for post in response.get('data', {}).get('posts', []):
+            if len(self.post_ids) < POST_IDS_POOL_SIZE:
+                self.post_ids.append(post['post_id'])
+            else:
+                self.post_ids[self.rng.randrange(POST_IDS_POOL_SIZE)] = post['post_id']
+
+    async def run_jobs(self, jobs):
+        jobs = iter(jobs)
+
+        async def worker():
+            client = Client(self.server_host, self.server_port, self.protocol)
+            try:
+                for request_type, request, on_response in jobs:
+                    # The server sheds signups and signins it cannot hash in time, lost users would turn into 404s later
+                    while (await self.send(client, request_type, request, on_response)).get('code') == 503:
+                        await asyncio.sleep(BUSY_RETRY_DELAY)
+            finally:
+                await client.disconnect()
+
+        await asyncio.gather(*(worker() for _ in range(self.clients)))
+
+    async def send(self, client, request_type, request, on_response=None, stats=None):
+        started = time.perf_counter()
+        response = await client.send(request)
+        latency = time.perf_counter() - started
+
+        if stats is not None:
+            stats.add(request_type, latency, response.get('code'))
+        if response.get('code') != 200:
+            logging.debug('{} failed: {}'.format(request_type, response.get('data')))
+        elif on_response is not None:
+            on_response(response)
+        return response
+
+    async def populate(self):
+        started = time.perf_counter()
+        await self.run_jobs(self.signup_request(user) for user in range(self.users))
+        await self.run_jobs(self.signin_request(user) for user in range(self.users))
+        logging.info('Signed up {} users in {:.1f}s'.format(len(self.tokens), time.perf_counter() - started))
+
+        started = time.perf_counter()
+        graph = make_follow_graph(self.rng, self.users, self.avg_follows, self.skew)
+        await self.run_jobs(self.follow_request(follower, user) for user, follower in graph if follower in self.tokens)
+        logging.info('Created {} follows in {:.1f}s'.format(len(graph), time.perf_counter() - started))
+
+        started = time.perf_counter()
+        await self.run_jobs(self.post_request(user) for user in list(self.signed_in) for _ in range(self.posts_per_user))
+        await self.run_jobs(self.get_user_posts_request(None, user) for user in range(self.users))
+        logging.info('Created {} posts in {:.1f}s'.format(len(self.tokens) * self.posts_per_user, time.perf_counter() - started))
+
+    async def load(self):
+        request_types = [request_type for request_type, _ in self.mix]
+        cum_weights = list(itertools.accumulate(weight for _, weight in self.mix))
+
+        stats = Stats()
+        warmup_end = time.perf_counter() + self.warmup
+        deadline = warmup_end + self.duration
+
+        def jobs():
+            while time.perf_counter() < deadline:
+                request_type = self.rng.choices(request_types, cum_weights=cum_weights)[0]
+                yield self.type_to_request[request_type]()
+
+        async def worker():
+            client = Client(self.server_host, self.server_port, self.protocol)
+            try:
+                for request_type, request, on_response in jobs():
+                    measured = time.perf_counter() >= warmup_end
+                    if measured and stats.started is None:
+                        stats.started = time.perf_counter()
+                    await self.send(client, request_type, request, on_response, stats if measured else None)
+            finally:
+                await client.disconnect()
+
+        await asyncio.gather(*(worker() for _ in range(self.clients)))
+        stats.finished = time.perf_counter()
+        return stats
+
+    async def run(self):
+        await self.populate()
+        return await self.load()
+
+    def signup_request(self, user=None):
+        if user is None:
+            user = next(self.new_users)
+        request = {'type': 'signup', 'username': self.username(user), 'password': self.password}
+        return 'signup', request, None
+
+    def signin_request(self, user=None):
+        if user is None:
+            user = self.random_user()
+
+        def on_response(response):
+            if user not in self.tokens:
+                self.signed_in.append(user)
+            self.tokens[user] = response['data']['auth_token']
+
+        request = {'type': 'signin', 'username': self.username(user), 'password': self.password}
+        return 'signin', request, on_response
+
+    def post_request(self, user=None):
+        if user is None:
+            user = self.random_user()
+        request = {'type': 'post', 'auth': self.auth(user), 'text': 'Post {} of {}'.format(self.rng.random(), self.username(user))}
+        return 'post', request, None
+
+    def follow_request(self, follower=None, user=None):
+        if follower is None:
+            follower = self.random_user()
+        if user is None:
+            # Popular users get most of the new followers, the same way as in the generated graph
+            user = min(int(self.rng.paretovariate(self.skew)) - 1, self.users - 1)
+            if user == follower:
+                user = (user + 1) % self.users
+            if user in self.following[follower]:
+                return self.unfollow_request(follower)
+
+        def on_response(response):
+            self.following[follower].add(user)
+
+        request = {'type': 'follow', 'auth': self.auth(follower), 'username_to_follow': self.username(user)}
+        return 'follow', request, on_response
+
+    def unfollow_request(self, follower=None):
+        if follower is None:
+            follower = self.random_user()
+        if not self.following[follower]:
+            return self.follow_request(follower)
+        user = self.rng.choice(list(self.following[follower]))
+        self.following[follower].discard(user)
+
+        request = {'type': 'unfollow', 'auth': self.auth(follower), 'username_to_unfollow': self.username(user)}
+        return 'unfollow', request, None
+
+    def like_request(self):
+        if not self.post_ids:
+            return self.get_user_feed_request()
+        for _ in range(LIKE_ATTEMPTS):
+            user, post_id = self.random_user(), self.rng.choice(self.post_ids)
+            if (user, post_id) not in self.liked:
+                break
+        else:
+            return self.get_user_feed_request()
+
+        self.liked.add((user, post_id))
+        request = {'type': 'like', 'auth': self.auth(user), 'post_id': post_id}
+        return 'like', request, None
+
+    def get_user_posts_request(self, user=None, author=None):
+        if user is None:
+            user = self.random_user()
+        if author is None:
+            author = self.rng.randrange(self.users)
+        request = {'type': 'get_user_posts', 'auth': self.auth(user), 'username': self.username(author), 'limit': PAGE_LIMIT}
+        return 'get_user_posts', request, self.add_post_ids
+
+    def get_user_feed_request(self):
+        request = {'type': 'get_user_feed', 'auth': self.auth(self.random_user()), 'limit': PAGE_LIMIT}
+        return 'get_user_feed', request, self.add_post_ids
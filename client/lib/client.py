@@ -1,33 +1,62 @@
 import asyncio
+import json
 import logging
 import sys
+import time
 import traceback
 
 from lib.connection import Connection
 
 
+# Access tokens are refreshed this many seconds before they expire (or halfway through a shorter lifetime)
+REFRESH_MARGIN = 300
+BAD_AUTH_TOKEN = 'Bad auth token, you should sign in'
+
+
 class Client:
-    def __init__(self, server_host, server_port):
+    def __init__(self, server_host, server_port, protocol='binary'):
         self.server_host = server_host
         self.server_port = server_port
+        self.protocol = protocol
 
         self.no_auth_check_handlers = ['signup', 'signin']
 
         self.type_to_params = {
             'signup': ('username', 'password'),
             'signin': ('username', 'password'),
+            'signout': (),
             'post': ('text',),
             'follow': ('username_to_follow',),
             'unfollow': ('username_to_unfollow',),
             'like': ('post_id',),
-            'get_user_posts': ('username',),
+            'get_user_posts': ('username', 'limit', 'cursor'),
+            'get_user_feed': ('limit', 'cursor'),
             'get_followed_users': ('username',),
             'get_following_users': ('username',),
+            'admin': ('tables',),
+            'metrics': (),
+            'batch': ('requests', 'atomic'),
+        }
+
+        # Parameters that are not plain strings
+        self.param_parsers = {
+            'requests': json.loads,
+            'atomic': lambda value: value.lower() in ('y', 'yes', 'true', '1'),
+        }
+
+        # Parameters taken from the session instead of being asked from the user
+        self.type_to_context_params = {
+            'signout': ('refresh_token',),
+        }
+
+        self.type_to_partial_callback = {
+            'admin': self.admin_partial_callback,
         }
 
         self.type_to_callback = {
             'signup': self.signup_callback,
             'signin': self.signin_callback,
+            'signout': self.signout_callback,
             'post': self.post_callback,
             'follow': self.follow_callback,
             'unfollow': self.unfollow_callback,
@@ -37,11 +66,124 @@ class Client:
             'get_followed_users': self.get_followed_users_callback,
             'get_following_users': self.get_following_users_callback,
             'admin': self.admin_callback,
+            'metrics': self.metrics_callback,
+            'batch': self.batch_callback,
         }
 
         self.context = {}
 
+        self.conn = None
+        self.next_request_id = 0
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection(self.server_host, self.server_port)
+        self.conn = Connection(reader, writer)
+        if self.protocol == 'binary':
+            await self.conn.negotiate()
+
+    async def disconnect(self):
+        if self.conn is None:
+            return
+
+        conn, self.conn = self.conn, None
+        try:
+            await conn.close()
+        except Exception as e:
+            logging.warning('Failed to close connection: {}'.format(e))
+
+    async def send(self, request, on_partial=None):
+        return (await self.pipeline([request], on_partial))[0]
+
+    async def pipeline(self, requests, on_partial=None):
+        for request in requests:
+            request['request_id'] = self.next_request_id
+            self.next_request_id += 1
+
+        for attempt in range(2):
+            responses = []
+            answered = False
+            try:
+                if self.conn is None:
+                    await self.connect()
+
+                for request in requests:
+                    await self.conn.write(request)
+
+                while len(responses) < len(requests):
+                    response = await self.conn.read()
+                    if response is None:
+                        raise ConnectionResetError('Connection closed by server')
+                    answered = True
+
+                    if response.get('partial'):
+                        if on_partial is not None:
+                            on_partial(response)
+                        continue
+                    responses.append(response)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+                await self.disconnect()
+                # Retrying is only safe while the server has not answered anything yet,
+                # i.e. it has most likely dropped an idle connection.
+                if attempt or answered:
+                    raise
+                logging.info('Reconnecting after connection failure: {}'.format(e))
+                continue
+
+            by_id = {response.get('request_id'): response for response in responses}
+            return [by_id.get(request['request_id'], response) for request, response in zip(requests, responses)]
+
+    async def batch(self, requests, atomic=False):
+        # Sub-requests go without auth, the server checks the auth of the whole batch once.
+        # With atomic=True only writes are allowed and they are committed all together or not at all.
+        auth = await self.get_auth()
+        if auth is None:
+            raise Exception('You should signin first')
+
+        request = {'type': 'batch', 'auth': auth, 'requests': list(requests), 'atomic': atomic}
+        response = await self.send(request)
+        if response.get('code') == 403 and response.get('data') == BAD_AUTH_TOKEN and await self.refresh_auth():
+            request['auth'] = await self.get_auth()
+            response = await self.send(request)
+        return response
+
+    def update_auth(self, response):
+        self.context['auth_token'] = response.get('auth_token')
+        if response.get('refresh_token'):
+            self.context['refresh_token'] = response['refresh_token']
+
+        expires_in = response.get('expires_in')
+        self.context['refresh_at'] = time.time() + expires_in - min(REFRESH_MARGIN, expires_in / 2) if expires_in else None
+
+    async def refresh_auth(self):
+        if not self.context.get('refresh_token'):
+            return False
+
+        response = await self.send({'type': 'refresh', 'refresh_token': self.context['refresh_token']})
+        if response.get('code') != 200:
+            logging.warning('Failed to refresh auth token: {}'.format(response.get('data')))
+            return False
+
+        self.update_auth(response.get('data', {}))
+        return True
+
+    async def get_auth(self):
+        refresh_at = self.context.get('refresh_at')
+        if refresh_at is not None and time.time() >= refresh_at:
+            await self.refresh_auth()
+
+        username = self.context.get('username')
+        auth_token = self.context.get('auth_token')
+        if not username or not auth_token:
+            return None
+        return {'username': username, 'auth_token': auth_token}
+
     async def handle_session(self):
+        try:
+            await self._handle_session()
+        finally:
+            await self.disconnect()
+
+    async def _handle_session(self):
         while True:
             try:
                 print('Enter command name:')
@@ -63,24 +205,32 @@ class Client:
                 request = {'type': action}
 
                 if action not in self.no_auth_check_handlers:
-                    username = self.context.get('username')
-                    auth_token = self.context.get('auth_token')
-                    if not username or not auth_token:
+                    auth = await self.get_auth()
+                    if auth is None:
                         print('You should signin first')
                         continue
 
-                    request['auth'] = {'username': username, 'auth_token': auth_token}
+                    request['auth'] = auth
 
                 for param in self.type_to_params.get(action, ()):
                     print('Enter {}:'.format(param))
                     request[param] = sys.stdin.readline().strip()
+                    if param in self.param_parsers:
+                        request[param] = self.param_parsers[param](request[param])
+                for param in self.type_to_context_params.get(action, ()):
+                    request[param] = self.context.get(param)
 
-                reader, writer = await asyncio.open_connection(self.server_host, self.server_port)
-                conn = Connection(reader, writer)
+                on_partial = None
+                if action in self.type_to_partial_callback:
+                    on_partial = lambda partial: self.type_to_partial_callback[action](request, partial.get('data', {}))
+                    request['stream'] = True
 
-                await conn.write(request)
-                response = await conn.read()
-                await conn.close()
+                response = await self.send(request, on_partial)
+
+                # The access token may have expired while the session was idle, refresh it once and retry
+                if response.get('code') == 403 and response.get('data') == BAD_AUTH_TOKEN and await self.refresh_auth():
+                    request['auth'] = await self.get_auth()
+                    response = await self.send(request, on_partial)
 
                 if response.get('code') == 200:
                     self.type_to_callback.get(action)(request, response.get('data', {}))
@@ -99,7 +249,11 @@ class Client:
     def signin_callback(self, request, response):
         print('User {} logged in'.format(request['username']))
         self.context['username'] = request['username']
-        self.context['auth_token'] = response.get('auth_token')
+        self.update_auth(response)
+
+    def signout_callback(self, request, response):
+        print('User {} logged out'.format(self.context.get('username')))
+        self.context.clear()
 
     def post_callback(self, request, response):
         print('Post successful')
@@ -113,15 +267,19 @@ class Client:
     def like_callback(self, request, response):
         print('Liked {}'.format(request['post_id']))
 
+    def print_posts_page(self, response):
+        for post in response.get('posts', []):
+            print(post)
+        if response.get('next_cursor'):
+            print('Next page cursor: {}'.format(response['next_cursor']))
+
     def get_user_posts_callback(self, request, response):
         print('Posts of user {}:'.format(request['username']))
-        for post in response:
-            print(post)
+        self.print_posts_page(response)
 
     def get_user_feed_callback(self, request, response):
         print('Posts feed:')
-        for post in response:
-            print(post)
+        self.print_posts_page(response)
 
     def get_followed_users_callback(self, request, response):
         print('Users followed by {}:'.format(request['username']))
@@ -133,8 +291,26 @@ class Client:
         for user in response:
             print(user)
 
+    def admin_partial_callback(self, request, response):
+        if response.get('table') != self.context.get('admin_table'):
+            self.context['admin_table'] = response.get('table')
+            print('All {}:'.format(response.get('table')))
+        for item in response.get('rows', []):
+            print(item)
+
     def admin_callback(self, request, response):
-        for k, v in response.items():
-            print('All {}:'.format(k))
-            for item in v:
-                print(item)
+        self.context.pop('admin_table', None)
+        for k, v in response.get('counts', {}).items():
+            print('Total {}: {}'.format(k, v))
+
+    def batch_callback(self, request, response):
+        for sub_request, result in zip(request['requests'], response.get('results', [])):
+            print('{}: {} {}'.format(sub_request.get('type'), result.get('code'), result.get('data')))
+
+    def metrics_callback(self, request, response):
+        for name, histograms in response.get('histograms', {}).items():
+            print('{} latency, seconds:'.format(name))
+            for label, histogram in sorted(histograms.items()):
+                print('  {}: {}'.format(label, histogram))
+        for key in ('in_flight', 'responses', 'server'):
+            print('{}: {}'.format(key, response.get(key)))
@@ -1,15 +1,116 @@
+import asyncio
 import base64
 import json
 import logging
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# A base64 line never starts with a zero byte, so it is used to tell the binary protocol handshake apart
+MAGIC = b'\x00STW'
+HANDSHAKE = struct.Struct('>4sBB')
+
+ENCODING_JSON = 1
+ENCODING_MSGPACK = 2
+
+FLAG_COMPRESSION = 1
+
+FRAME_HEADER = struct.Struct('>IB')
+FRAME_COMPRESSED = 1
+
+COMPRESSION_THRESHOLD = 16 * 1024
+# Limit of a frame both on the wire and after decompression, the server uses a smaller one for requests
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+
+def supported_encoding(encoding):
+    if encoding == ENCODING_MSGPACK and msgpack is not None:
+        return ENCODING_MSGPACK
+    return ENCODING_JSON
+
+
+def encode(message, encoding):
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message, separators=(',', ':')).encode()
+
+
+def decode(data, encoding):
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
 
 
 class Connection:
-    def __init__(self, connection_reader, connection_writer):
+    def __init__(self, connection_reader, connection_writer, max_frame_size=MAX_FRAME_SIZE):
         self.connection_reader = connection_reader
         self.connection_writer = connection_writer
+        self.max_frame_size = max_frame_size
+
+        # None until the peer either sends a handshake or a first base64 line
+        self.binary = None
+        self.encoding = ENCODING_JSON
+        self.compression = False
+
+        # Sizes of the last read and written messages on the wire, used by the request log
+        self.last_read_size = 0
+        self.last_write_size = 0
+
+    async def negotiate(self, encoding=ENCODING_MSGPACK, compression=True):
+        flags = FLAG_COMPRESSION if compression else 0
+        self.connection_writer.write(HANDSHAKE.pack(MAGIC, supported_encoding(encoding), flags))
+        await self.connection_writer.drain()
+
+        magic, encoding, flags = HANDSHAKE.unpack(await self.connection_reader.readexactly(HANDSHAKE.size))
+        if magic != MAGIC:
+            raise ConnectionError('Peer does not support binary protocol')
+
+        self.binary = True
+        self.encoding = encoding
+        self.compression = bool(flags & FLAG_COMPRESSION)
+        logging.debug('Negotiated binary protocol, encoding %s, compression %s', self.encoding, self.compression)
+
+    async def _accept_handshake(self):
+        magic, encoding, flags = HANDSHAKE.unpack(MAGIC[:1] + await self.connection_reader.readexactly(HANDSHAKE.size - 1))
+        if magic != MAGIC:
+            raise ConnectionError('Bad handshake')
+
+        self.binary = True
+        self.encoding = supported_encoding(encoding)
+        self.compression = bool(flags & FLAG_COMPRESSION)
+
+        self.connection_writer.write(HANDSHAKE.pack(MAGIC, self.encoding, FLAG_COMPRESSION if self.compression else 0))
+        await self.connection_writer.drain()
+        logging.debug('Accepted binary protocol, encoding %s, compression %s', self.encoding, self.compression)
 
     async def read(self):
-        data = await self.connection_reader.readline()
+        try:
+            prefix = b''
+            if self.binary is None:
+                prefix = await self.connection_reader.readexactly(1)
+                if prefix == MAGIC[:1]:
+                    await self._accept_handshake()
+                else:
+                    self.binary = False
+
+            if self.binary:
+                return await self._read_frame()
+            return self._decode_line(prefix + await self.connection_reader.readline())
+        except asyncio.IncompleteReadError:
+            logging.debug('Connection closed by peer')
+            return None
+
+    def _decode_line(self, data):
+        if not data:
+            logging.debug('Connection closed by peer')
+            return None
+
+        self.last_read_size = len(data)
         message = {}
 
         try:
@@ -17,14 +118,57 @@ class Connection:
         except:
             logging.warning('Invalid request')
 
-        logging.debug('Got message: {}'.format(message))
+        # Lazy formatting: messages can be megabytes long and are only rendered when DEBUG is enabled
+        logging.debug('Got message: %s', message)
         return message
 
+    async def _read_frame(self):
+        length, flags = FRAME_HEADER.unpack(await self.connection_reader.readexactly(FRAME_HEADER.size))
+        if length > self.max_frame_size:
+            raise ConnectionError('Frame of {} bytes is too large'.format(length))
+        data = await self.connection_reader.readexactly(length)
+
+        self.last_read_size = FRAME_HEADER.size + length
+        message = {}
+
+        try:
+            if flags & FRAME_COMPRESSED:
+                data = self._decompress(data)
+            message = decode(data, self.encoding)
+        except ConnectionError:
+            raise
+        except:
+            logging.warning('Invalid request')
+
+        logging.debug('Got message: %s', message)
+        return message
+
+    def _decompress(self, data):
+        # A small compressed frame can expand to gigabytes, so the output is bounded as well
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(data, self.max_frame_size)
+        if decompressor.unconsumed_tail:
+            raise ConnectionError('Decompressed frame is larger than {} bytes'.format(self.max_frame_size))
+        return data
+
     async def write(self, message):
-        logging.debug('Going to send message: {}'.format(message))
+        logging.debug('Going to send message: %s', message)
+
+        if not self.binary:
+            data = base64.b64encode(json.dumps(message).encode())
+            self.last_write_size = len(data) + 1
+            self.connection_writer.write(data + b'\n')
+            await self.connection_writer.drain()
+            return
+
+        data = encode(message, self.encoding)
+        flags = 0
+        if self.compression and len(data) > COMPRESSION_THRESHOLD:
+            data = zlib.compress(data, 1)
+            flags |= FRAME_COMPRESSED
 
-        data = base64.b64encode(json.dumps(message).encode())
-        self.connection_writer.write(data + b'\n')
+        self.last_write_size = FRAME_HEADER.size + len(data)
+        self.connection_writer.write(FRAME_HEADER.pack(len(data), flags) + data)
         await self.connection_writer.drain()
 
     async def close(self):
@@ -1,41 +1,41 @@
-import logging
-
 from argparse import ArgumentParser
 
 from lib.main import (
+    LOG_LEVELS, setup_logging,
     add_run_server_args, run_server_main,
     add_init_db_args, init_db_main,
+    add_migrate_db_args, migrate_db_main,
+    add_load_db_args, load_db_main,
     add_modify_admins_args, modify_admins_main,
 )
 
 
-def setup_logging():
-    logging.basicConfig()
-    logging.getLogger().setLevel(logging.DEBUG)
-    handlers = logging.getLogger().handlers
-    if handlers:
-        handlers[0].setFormatter(logging.Formatter("%(asctime)s\t%(levelname)s\t%(process)d\t%(thread)d\t%(message)s"))
-
-
 def parse_args():
     parser = ArgumentParser('SmallTwitter server')
+    parser.add_argument('--log_level', choices=LOG_LEVELS, default='INFO', help='DEBUG also logs every message, which is expensive for large responses')
     subparsers = parser.add_subparsers(dest='mode')
 
     add_run_server_args(subparsers.add_parser('run_server'))
     add_init_db_args(subparsers.add_parser('init_db'))
+    add_migrate_db_args(subparsers.add_parser('migrate_db'))
+    add_load_db_args(subparsers.add_parser('load_db'))
     add_modify_admins_args(subparsers.add_parser('modify_admins'))
 
     return parser.parse_args()
 
 
 def main():
-    setup_logging()
     args = parse_args()
+    setup_logging(args.log_level)
 
     if args.mode == 'run_server':
         run_server_main(args)
     elif args.mode == 'init_db':
         init_db_main(args)
+    elif args.mode == 'migrate_db':
+        migrate_db_main(args)
+    elif args.mode == 'load_db':
+        load_db_main(args)
     elif args.mode == 'modify_admins':
         modify_admins_main(args)
     else:
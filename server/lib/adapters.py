@@ -1,29 +1,55 @@
-from lib.exceptions import ItemNotFoundError
-from lib.transaction import Transaction
-
 from lib.models.user import User
 
 
-def construct_posts_list_response(posts):
+DEFAULT_PAGE_LIMIT = 100
+MAX_PAGE_LIMIT = 1000
+
+
+def parse_page_params(request):
+    limit = request.get('limit') or DEFAULT_PAGE_LIMIT
+    limit = int(limit)
+    if not 0 < limit <= MAX_PAGE_LIMIT:
+        raise ValueError('Bad page limit: {}'.format(limit))
+
+    after = None
+    page_cursor = request.get('cursor')
+    if page_cursor:
+        timestamp, post_id = page_cursor.split(':', 1)
+        after = (int(timestamp), post_id)
+
+    return limit, after
+
+
+def read_usernames(cursor, user_ids):
+    return {user.user_id: user.username for user in User.read_by_pks(cursor, user_ids)}
+
+
+def construct_posts_list_response(cursor, posts):
+    usernames = read_usernames(cursor, [post.user_id for post in posts])
+
     res = []
     for post in posts:
         post_dict = post.to_dict()
-        with Transaction() as tr:
-            try:
-                post_dict['username'] = User.read_by_pk(tr.cursor, post_dict.pop('user_id')).username
-            except ItemNotFoundError:
-                continue
+        username = usernames.get(post_dict.pop('user_id'))
+        if username is None:
+            continue
+        post_dict['username'] = username
         res.append(post_dict)
     return res
 
 
-def construct_follows_list_response(follows, followers_mode=False):
-    res = []
-    for follow in follows:
-        with Transaction() as tr:
-            try:
-                user_id = follow.user_id if not followers_mode else follow.follower_id
-                res.append(User.read_by_pk(tr.cursor, user_id).username)
-            except ItemNotFoundError:
-                continue
-    return res
+def construct_posts_page_response(cursor, posts, limit):
+    next_cursor = None
+    if len(posts) == limit:
+        next_cursor = '{}:{}'.format(posts[-1].timestamp, posts[-1].post_id)
+
+    return {
+        'posts': construct_posts_list_response(cursor, posts),
+        'next_cursor': next_cursor,
+    }
+
+
+def construct_follows_list_response(cursor, follows, followers_mode=False):
+    user_ids = [follow.user_id if not followers_mode else follow.follower_id for follow in follows]
+    usernames = read_usernames(cursor, user_ids)
+    return [usernames[user_id] for user_id in user_ids if user_id in usernames]
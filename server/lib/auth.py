@@ -7,11 +7,19 @@ import time
 
 import jwt
 
+from lib.cache import LRUCache
+from lib.metrics import metrics
+
+
+ACCESS_TOKEN = 'access'
+REFRESH_TOKEN = 'refresh'
+
 
 class AuthHandler:
     def __init__(self, pbkdf2_key_length=64, pbkdf2_digest_alg='sha512', pbkdf2_iterations=100000, pbkdf2_delimiter='::',
                  jwt_algorithm='ES512', jwt_private_key=None, jwt_public_key=None, jwt_tolerance_seconds=60 * 5,
-                 jwt_access_expiration_seconds=60 * 60 * 2, jwt_refresh_expiration_seconds=60 * 60 * 24 * 2):
+                 jwt_access_expiration_seconds=60 * 60 * 2, jwt_refresh_expiration_seconds=60 * 60 * 24 * 2,
+                 jwt_admin_claim_seconds=60 * 5, hash_pool=None, token_cache_size=10000, revocation_check=None):
         self.pbkdf2_key_length = pbkdf2_key_length
         self.pbkdf2_digest_alg = pbkdf2_digest_alg
         self.pbkdf2_iterations = pbkdf2_iterations
@@ -20,19 +28,39 @@ class AuthHandler:
         self.jwt_algorithm = jwt_algorithm
         self.jwt_private_key = jwt_private_key or os.environ.get('JWT_PRIVATE_KEY')
         self.jwt_public_key = jwt_public_key or os.environ.get('JWT_PUBLIC_KEY')
-        if self.jwt_public_key is None or self.jwt_public_key is None:
+        if self.jwt_private_key is None or self.jwt_public_key is None:
             raise Exception('No keys for jwt')
 
         self.jwt_tolerance_seconds = jwt_tolerance_seconds
         self.jwt_access_expiration_seconds = jwt_access_expiration_seconds
         self.jwt_refresh_expiration_seconds = jwt_refresh_expiration_seconds
+        self.jwt_admin_claim_seconds = jwt_admin_claim_seconds
+
+        algorithm = jwt.algorithms.get_default_algorithms()[self.jwt_algorithm]
+        self._jwt_private_key = algorithm.prepare_key(base64.decodebytes(self.jwt_private_key.encode('utf-8')))
+        self._jwt_public_key = algorithm.prepare_key(base64.decodebytes(self.jwt_public_key.encode('utf-8')))
+
+        self.token_cache = LRUCache(token_cache_size) if token_cache_size > 0 else None
+
+        self.hash_pool = hash_pool
 
+        # Called with the payload of every token authenticated by its claims, returns True if the token must be rejected
+        # (e.g. the user is deleted or the token is revoked)
+        self.revocation_check = revocation_check
+
+    def _pbkdf2(self, alg, password, salt, iterations, key_length):
+        args = (alg, bytes(password, 'utf-8'), salt, iterations, key_length)
+        if self.hash_pool is None:
+            return hashlib.pbkdf2_hmac(*args)
+        return self.hash_pool.pbkdf2(*args)
+
+    @metrics.timed('auth')
     def get_password_key(self, password):
         salt = secrets.token_bytes(self.pbkdf2_key_length)
 
-        digest = hashlib.pbkdf2_hmac(
+        digest = self._pbkdf2(
             self.pbkdf2_digest_alg,
-            bytes(password, 'utf-8'),
+            password,
             salt,
             self.pbkdf2_iterations,
             self.pbkdf2_key_length,
@@ -46,14 +74,24 @@ class AuthHandler:
 
         return self.pbkdf2_delimiter.join(parts)
 
+    def needs_rehash(self, password_key):
+        # Keys hashed under an older policy (weaker digest or fewer iterations) are upgraded on the next signin
+        alg, salt, digest, iterations = password_key.split(self.pbkdf2_delimiter)
+        return (
+            alg != self.pbkdf2_digest_alg
+            or int(iterations) < self.pbkdf2_iterations
+            or len(digest) != self.pbkdf2_key_length * 2
+        )
+
+    @metrics.timed('auth')
     def verify_password(self, password, password_key):
         alg, salt, digest, iterations = password_key.split(self.pbkdf2_delimiter)
         digest = bytes.fromhex(digest)
         iterations = int(iterations)
 
-        digest_ = hashlib.pbkdf2_hmac(
+        digest_ = self._pbkdf2(
             alg,
-            bytes(password, 'utf-8'),
+            password,
             bytes.fromhex(salt),
             iterations,
             len(digest),
@@ -62,13 +100,35 @@ class AuthHandler:
         return digest == digest_
 
 
-    def get_auth_token(self, user_id):
+    @metrics.timed('auth')
+    def get_auth_token(self, user_id, username=None, is_admin=False):
+        now = int(time.time())
+        payload = {
+            'user_id': user_id,
+            'exp': (now + self.jwt_access_expiration_seconds),
+            'typ': ACCESS_TOKEN,
+            # Identifies the token for signout
+            'jti': secrets.token_hex(16),
+        }
+        if username is not None:
+            # Requests authenticated by these claims do not read the user record
+            payload['username'] = username
+            payload['admin'] = bool(is_admin)
+            payload['admin_exp'] = now + self.jwt_admin_claim_seconds
+
+        return jwt.encode(payload, self._jwt_private_key, self.jwt_algorithm).decode('utf-8')
+
+    @metrics.timed('auth')
+    def get_refresh_token(self, user_id):
+        # jti identifies the token in the revocation list
         return jwt.encode(
             {
                 'user_id': user_id,
-                'exp': (int(time.time()) + self.jwt_access_expiration_seconds)
+                'exp': (int(time.time()) + self.jwt_refresh_expiration_seconds),
+                'typ': REFRESH_TOKEN,
+                'jti': secrets.token_hex(16),
             },
-            base64.decodebytes(self.jwt_private_key.encode('utf-8')),
+            self._jwt_private_key,
             self.jwt_algorithm,
         ).decode('utf-8')
 
@@ -77,7 +137,7 @@ class AuthHandler:
         try:
             return jwt.decode(
                 token,
-                base64.decodebytes(self.jwt_public_key.encode('utf-8')),
+                self._jwt_public_key,
                 algorithms=[self.jwt_algorithm],
                 leeway=self.jwt_tolerance_seconds,
                 verify=verify,
@@ -85,6 +145,56 @@ class AuthHandler:
         except jwt.exceptions.PyJWTError:
             return {}
 
+    def decode_auth_token(self, token):
+        if not isinstance(token, str):
+            return {}
+
+        if self.token_cache is None:
+            return self._decode_token(token)
+
+        key = hashlib.sha256(token.encode('utf-8')).digest()
+        payload = self.token_cache.get(key)
+        if payload is not None:
+            return payload
+
+        payload = self._decode_token(token)
+        if 'exp' in payload:
+            ttl = payload['exp'] + self.jwt_tolerance_seconds - time.time()
+            if ttl > 0:
+                self.token_cache.put(key, payload, ttl)
+        return payload
+
+    @metrics.timed('auth')
+    def decode_refresh_token(self, token):
+        if not isinstance(token, str):
+            return {}
+        payload = self._decode_token(token)
+        if payload.get('typ') != REFRESH_TOKEN or 'jti' not in payload:
+            return {}
+        return payload
+
+    @metrics.timed('auth')
+    def verify_token_claims(self, username, token):
+        # None if the token has no username claim (issued by an older server) and has to be checked against the user record,
+        # empty dict if the token is not valid for username
+        payload = self.decode_auth_token(token)
+        if payload and 'username' not in payload:
+            return None
+        if payload.get('username') != username or payload.get('typ', ACCESS_TOKEN) != ACCESS_TOKEN or 'user_id' not in payload:
+            return {}
+        if self.revocation_check is not None and self.revocation_check(payload):
+            return {}
+        return payload
+
+    def admin_claim(self, payload):
+        # The admin role changes rarely but must not outlive a demotion for hours, so it has its own short expiration
+        if payload.get('admin_exp', 0) < time.time():
+            return None
+        return bool(payload.get('admin'))
+
+    @metrics.timed('auth')
     def verify_auth_token(self, user_id, token):
-        logging.debug('Decoded token is {}'.format(self._decode_token(token)))
-        return self._decode_token(token).get('user_id') == user_id
+        payload = self.decode_auth_token(token)
+        logging.debug('Decoded token is %s', payload)
+        # Tokens issued before refresh tokens existed carry no typ and are access tokens
+        return payload.get('user_id') == user_id and payload.get('typ', ACCESS_TOKEN) == ACCESS_TOKEN
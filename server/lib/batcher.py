@@ -0,0 +1,116 @@
+import logging
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+
+from lib.metrics import metrics
+from lib.transaction import Transaction, WRITE
+
+
+class WriteBatcher:
+    def __init__(self, max_batch_size=100, max_delay=0.002):
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+        self.max_batch = 0
+        self.failed_batches = 0
+
+        self._thread = threading.Thread(target=self._run, name='write-batcher', daemon=True)
+        self._thread.start()
+
+    def enqueue(self, func):
+        # func(cursor) runs in the writer thread, the future gets its result once the whole batch is committed
+        future = Future()
+        self._queue.put((func, future))
+        return future
+
+    def submit(self, func):
+        started = time.perf_counter()
+        try:
+            return self.enqueue(func).result()
+        finally:
+            metrics.add('db', time.perf_counter() - started)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'batches': self.batches,
+                'operations': self.operations,
+                'max_batch': self.max_batch,
+                'failed_batches': self.failed_batches,
+            }
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None, True
+
+        # Everything queued while the previous batch was committing goes in at once,
+        # then the batch waits up to max_delay for more writers
+        batch = [item]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            batch, stopped = self._next_batch()
+            if batch:
+                self._commit(batch)
+
+    def _commit(self, batch):
+        results = []
+        try:
+            with Transaction(WRITE) as tr:
+                for func, _ in batch:
+                    # A failing operation is rolled back alone and does not affect the rest of the batch
+                    tr.cursor.execute('SAVEPOINT operation')
+                    try:
+                        results.append((True, func(tr.cursor)))
+                    except Exception as e:
+                        tr.cursor.execute('ROLLBACK TO SAVEPOINT operation')
+                        results.append((False, e))
+                    tr.cursor.execute('RELEASE SAVEPOINT operation')
+        except Exception as e:
+            logging.exception('Failed to commit a batch of {} writes: {}'.format(len(batch), e))
+            with self._lock:
+                self.failed_batches += 1
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        with self._lock:
+            self.batches += 1
+            self.operations += len(batch)
+            self.max_batch = max(self.max_batch, len(batch))
+
+        for (_, future), (ok, result) in zip(batch, results):
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
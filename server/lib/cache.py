@@ -0,0 +1,82 @@
+import collections
+import itertools
+import threading
+import time
+
+
+# Versions order reads against invalidations: an invalidation gets a version greater than that of every read started before it
+_versions = itertools.count(1)
+
+
+def cache_version():
+    return next(_versions)
+
+
+class LRUCache:
+    def __init__(self, max_size=10000, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+        # Versions of the latest invalidations, keys evicted from here are treated as invalidated at the floor version
+        self._invalidated = collections.OrderedDict()
+        self._invalidated_floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, ttl=None, version=None):
+        # version is cache_version() taken before the value was read, the value is dropped if key was invalidated since then
+        with self._lock:
+            if version is not None and self._invalidated.get(key, self._invalidated_floor) > version:
+                self.stale_puts += 1
+                return
+            self._items[key] = (value, time.monotonic() + (ttl if ttl is not None else self.ttl))
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, *keys):
+        version = cache_version()
+        with self._lock:
+            for key in keys:
+                if self._items.pop(key, None) is not None:
+                    self.invalidations += 1
+                self._invalidated[key] = version
+                self._invalidated.move_to_end(key)
+            while len(self._invalidated) > self.max_size:
+                _, evicted = self._invalidated.popitem(last=False)
+                self._invalidated_floor = max(self._invalidated_floor, evicted)
+
+    def clear(self):
+        version = cache_version()
+        with self._lock:
+            self._items.clear()
+            self._invalidated.clear()
+            self._invalidated_floor = version
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'stale_puts': self.stale_puts,
+            }
@@ -0,0 +1,41 @@
+import collections
+import threading
+
+from lib.transaction import Transaction, WRITE
+
+from lib.models.post import Post
+
+
+class LikeCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = collections.Counter()
+        self.flushed = 0
+
+    def add(self, post_id, likes=1):
+        with self._lock:
+            self._pending[post_id] += likes
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, collections.Counter()
+        if not pending:
+            return
+
+        try:
+            with Transaction(WRITE) as tr:
+                Post.add_likes(tr.cursor, pending.items())
+        except:
+            with self._lock:
+                self._pending.update(pending)
+            raise
+
+        self.flushed += sum(pending.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending_posts': len(self._pending),
+                'pending_likes': sum(self._pending.values()),
+                'flushed_likes': self.flushed,
+            }
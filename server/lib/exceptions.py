@@ -3,3 +3,8 @@
 class ItemNotFoundError(Exception):
     def __init__(self):
         super().__init__('Item not found')
+
+
+class ServerBusyError(Exception):
+    def __init__(self):
+        super().__init__('Server is busy')
@@ -0,0 +1,59 @@
+import asyncio
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.exceptions import ServerBusyError
+
+
+class Executor:
+    def __init__(self, max_workers=None, max_queue_size=1024):
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.max_queue_size = max_queue_size
+
+        self.thread_pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix='handler')
+
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'max_queue_size': self.max_queue_size,
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'max_queue_depth': self.max_queue_depth,
+            }
+
+    async def run(self, func, *args):
+        with self._lock:
+            if self.queued >= self.max_queue_size:
+                self.rejected += 1
+                raise ServerBusyError()
+            self.queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queued)
+
+        return await asyncio.get_running_loop().run_in_executor(self.thread_pool, self._run, func, args)
+
+    def _run(self, func, args):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+
+        try:
+            return func(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+    def shutdown(self):
+        self.thread_pool.shutdown(wait=True)
@@ -1,13 +1,34 @@
+import asyncio
 import logging
 import time
 
-from lib.adapters import construct_posts_list_response, construct_follows_list_response
-from lib.exceptions import ItemNotFoundError
-from lib.transaction import Transaction
+from lib.adapters import parse_page_params, construct_posts_page_response, construct_follows_list_response
+from lib.exceptions import ItemNotFoundError, ServerBusyError
+from lib.metrics import metrics
+from lib.transaction import Transaction, READ, WRITE
 
 from lib.models.user import User
 from lib.models.post import Post
 from lib.models.follow import Follow
+from lib.models.like import Like
+from lib.models.celebrity import Celebrity
+from lib.models.revoked_token import RevokedToken
+from lib.models.timeline import Timeline, BACKFILL_POSTS_LIMIT
+
+
+EXPORT_CHUNK_SIZE = 1000
+
+MAX_BATCH_SIZE = 100
+# Request types allowed inside a batch, atomic batches only accept the writing ones
+BATCH_WRITE_TYPES = ('post', 'follow', 'unfollow', 'like')
+BATCH_TYPES = BATCH_WRITE_TYPES + ('get_user_posts', 'get_user_feed', 'get_followed_users', 'get_following_users')
+
+# Table name in admin requests -> (model, key in the non-streaming response)
+ADMIN_TABLES = {
+    'users': (User, 'users'),
+    'posts': (Post, 'posts'),
+    'follows': (Follow, 'folows'),
+}
 
 
 def construct_result(code=200, data={}):
@@ -17,16 +38,42 @@ def construct_result(code=200, data={}):
     }
 
 
+class BatchAborted(Exception):
+    pass
+
+
+class PendingWrite:
+    # A write queued to the write batcher. The event loop awaits its commit, so waiting writers do not hold
+    # handler threads and a batch can be larger than the handler thread pool
+    def __init__(self, future, then):
+        self.future = future
+        self.then = then
+
+    async def wait(self):
+        try:
+            return self.then(await asyncio.wrap_future(self.future))
+        except Exception as e:
+            logging.exception('Unhandled exception during batched write occured: {}'.format(e))
+            return construct_result(500, 'Error occured')
+
+
 class Handler:
-    def __init__(self, auth_handler):
+    def __init__(self, auth_handler, send_partial=None, like_counter=None, write_batcher=None, defer_writes=False):
         self.auth_handler = auth_handler
+        self.send_partial = send_partial
+        self.like_counter = like_counter
+        self.write_batcher = write_batcher
+        # If set, batched writes are returned as PendingWrite for the caller's event loop to await
+        self.defer_writes = defer_writes
 
-        self.no_auth_check_handlers = ['signup', 'signin']
-        self.admin_check_handlers = ['admin']
+        self.no_auth_check_handlers = ['signup', 'signin', 'refresh']
+        self.admin_check_handlers = ['admin', 'metrics']
 
         self.type_to_handler = {
             'signup': self.handle_signup,
             'signin': self.handle_signin,
+            'refresh': self.handle_refresh,
+            'signout': self.handle_signout,
             'post': self.handle_post,
             'follow': self.handle_follow,
             'unfollow': self.handle_unfollow,
@@ -36,13 +83,38 @@ class Handler:
             'get_followed_users': self.handle_get_followed_users,
             'get_following_users': self.handle_get_following_users,
             'admin': self.handle_admin_info,
+            'metrics': self.handle_metrics,
+            'batch': self.handle_batch,
         }
 
         self.context = {}
 
+        # Set while an atomic batch runs: its writes share one transaction and side effects wait for the commit
+        self.batch_cursor = None
+        self.after_commit = None
+
+    def request_label(self, request):
+        # Only known types are used as metric labels, so clients cannot blow up the number of series
+        request_type = request.get('type') if isinstance(request, dict) else None
+        return request_type if isinstance(request_type, str) and request_type in self.type_to_handler else 'unknown'
+
     def handle_request(self, request):
+        metrics.begin()
+        started = time.perf_counter()
+        try:
+            return self._handle_request(request)
+        finally:
+            timings = metrics.end()
+            label = self.request_label(request)
+            metrics.observe('handler', label, time.perf_counter() - started)
+            for kind, seconds in timings.items():
+                metrics.observe(kind, label, seconds)
+
+    def _handle_request(self, request):
         try:
             request_type = request.get('type')
+            if not isinstance(request_type, str):
+                return construct_result(400, 'Bad request')
 
             if request_type not in self.no_auth_check_handlers:
                 username = request.get('auth', {}).get('username')
@@ -50,31 +122,66 @@ class Handler:
                 if not username or not token:
                     return construct_result(400, 'Bad request')
 
-                with Transaction() as tr:
-                    try:
-                        user = User.read_by_name(tr.cursor, username)
-                    except ItemNotFoundError:
-                        return construct_result(404, 'User not found')
-
-                if not self.auth_handler.verify_auth_token(user.user_id, token):
+                claims = self.auth_handler.verify_token_claims(username, token)
+                if claims is None:
+                    with Transaction(READ) as tr:
+                        try:
+                            user = User.read_by_name(tr.cursor, username)
+                        except ItemNotFoundError:
+                            return construct_result(404, 'User not found')
+
+                    if not self.auth_handler.verify_auth_token(user.user_id, token):
+                        return construct_result(403, 'Bad auth token, you should sign in')
+                    user_id, is_admin = user.user_id, user.is_admin
+                elif not claims:
                     return construct_result(403, 'Bad auth token, you should sign in')
+                else:
+                    user_id, is_admin = claims['user_id'], self.auth_handler.admin_claim(claims)
 
-                self.context['user_id'] = user.user_id
+                if request_type in self.admin_check_handlers:
+                    if is_admin is None:
+                        with Transaction(READ) as tr:
+                            try:
+                                is_admin = User.read_by_pk(tr.cursor, user_id).is_admin
+                            except ItemNotFoundError:
+                                return construct_result(404, 'User not found')
+                    if not is_admin:
+                        return construct_result(403, 'Access denied')
+
+                self.context['user_id'] = user_id
 
             return self.type_to_handler.get(request_type, lambda _: construct_result(400, 'Bad request'))(request)
         except KeyboardInterrupt:
             raise
+        except ServerBusyError:
+            return construct_result(503, 'Server is busy')
         except Exception as e:
             logging.exception('Unhandled exception during request handling occured: {}'.format(e))
             return construct_result(500, 'Error occured')
 
+    def run_write(self, func, then=None):
+        # func(cursor) either runs in its own transaction or is committed together with other requests' writes,
+        # then(result) runs after the commit and returns the response
+        then = then or (lambda res: res)
+        if self.batch_cursor is not None:
+            return then(func(self.batch_cursor))
+        if self.write_batcher is not None:
+            if self.defer_writes:
+                return PendingWrite(self.write_batcher.enqueue(func), then)
+            return then(self.write_batcher.submit(func))
+        with Transaction(WRITE) as tr:
+            res = func(tr.cursor)
+        return then(res)
+
     def handle_signup(self, request):
         username = request.get('username')
         password = request.get('password')
         if not username or not password:
             return construct_result(400, 'Bad request')
 
-        with Transaction() as tr:
+        password_key = self.auth_handler.get_password_key(password)
+
+        with Transaction(WRITE) as tr:
             no_users = False
             try:
                 user = User.read_by_name(tr.cursor, username)
@@ -84,7 +191,7 @@ class Handler:
             if not no_users:
                 return construct_result(400, 'User already exists')
 
-            User(None, username, self.auth_handler.get_password_key(password)).create_me(tr.cursor)
+            User(None, username, password_key).create_me(tr.cursor)
 
         return construct_result()
 
@@ -94,16 +201,76 @@ class Handler:
         if not username or not password:
             return construct_result(400, 'Bad request')
 
-        with Transaction() as tr:
+        with Transaction(READ) as tr:
             try:
                 user = User.read_by_name(tr.cursor, username)
             except ItemNotFoundError:
                 return construct_result(404, 'User not found')
 
-            if not self.auth_handler.verify_password(password, user.password_key):
-                return construct_result(400, 'Bad password')
+        if not self.auth_handler.verify_password(password, user.password_key):
+            return construct_result(400, 'Bad password')
+
+        if self.auth_handler.needs_rehash(user.password_key):
+            self.rehash_password(user, password)
+
+        return construct_result(200, {
+            'auth_token': self.auth_handler.get_auth_token(user.user_id, user.username, user.is_admin),
+            'refresh_token': self.auth_handler.get_refresh_token(user.user_id),
+            'expires_in': self.auth_handler.jwt_access_expiration_seconds,
+        })
+
+    def handle_refresh(self, request):
+        payload = self.auth_handler.decode_refresh_token(request.get('refresh_token'))
+        if not payload:
+            return construct_result(403, 'Bad refresh token, you should sign in')
+
+        with Transaction(READ) as tr:
+            if RevokedToken.exists(tr.cursor, payload['jti']):
+                return construct_result(403, 'Bad refresh token, you should sign in')
+
+            try:
+                user = User.read_by_pk(tr.cursor, payload['user_id'])
+            except ItemNotFoundError:
+                return construct_result(404, 'User not found')
 
-        return construct_result(200, {'auth_token': self.auth_handler.get_auth_token(user.user_id)})
+        return construct_result(200, {
+            'auth_token': self.auth_handler.get_auth_token(user.user_id, user.username, user.is_admin),
+            'expires_in': self.auth_handler.jwt_access_expiration_seconds,
+        })
+
+    def handle_signout(self, request):
+        payload = self.auth_handler.decode_refresh_token(request.get('refresh_token'))
+        if not payload or payload.get('user_id') != self.context['user_id']:
+            return construct_result(400, 'Bad request')
+
+        expired = int(time.time()) - self.auth_handler.jwt_tolerance_seconds
+        # The access token of this request is revoked too, tokens issued by older servers have no jti
+        access_payload = self.auth_handler.decode_auth_token(request['auth']['auth_token'])
+
+        def write(cursor):
+            RevokedToken.revoke(cursor, payload['jti'], payload['exp'], expired)
+            if 'jti' in access_payload:
+                RevokedToken.revoke(cursor, access_payload['jti'], access_payload['exp'], expired)
+            return construct_result()
+
+        revocation_check = self.auth_handler.revocation_check
+
+        def then(res):
+            if res['code'] == 200 and revocation_check is not None and 'jti' in access_payload:
+                revocation_check.revoked(access_payload)
+            return res
+
+        return self.run_write(write, then)
+
+    def rehash_password(self, user, password):
+        try:
+            user.password_key = self.auth_handler.get_password_key(password)
+        except ServerBusyError:
+            # Signin already succeeded, the key is upgraded on one of the next signins
+            return
+
+        with Transaction(WRITE) as tr:
+            user.update_me(tr.cursor)
 
     def handle_post(self, request):
         text = request.get('text')
@@ -111,133 +278,245 @@ class Handler:
             return construct_result(400, 'Bad request')
 
         ts = int(time.time())
+        user_id = self.context['user_id']
 
-        with Transaction() as tr:
-            Post(self.context['user_id'], None, text, ts).create_me(tr.cursor)
+        def write(cursor):
+            post = Post(user_id, None, text, ts)
+            post.create_me(cursor)
+            Timeline.fan_out(cursor, post)
+            return construct_result()
 
-        return construct_result()
+        return self.run_write(write)
 
     def handle_follow(self, request):
         username_to_follow = request.get('username_to_follow')
         if not username_to_follow:
             return construct_result(400, 'Bad request')
 
-        with Transaction() as tr:
+        user_id = self.context['user_id']
+
+        def write(cursor):
             try:
-                user_to_follow = User.read_by_name(tr.cursor, username_to_follow)
+                user_to_follow = User.read_by_name(cursor, username_to_follow)
             except ItemNotFoundError:
                 return construct_result(404, 'User not found')
 
-            Follow(None, user_to_follow.user_id, self.context['user_id']).create_me(tr.cursor)
+            try:
+                Follow.read_by_ids(cursor, user_to_follow.user_id, user_id)
+                return construct_result(400, 'User already followed')
+            except ItemNotFoundError:
+                pass
 
-        return construct_result()
+            Follow(None, user_to_follow.user_id, user_id).create_me(cursor)
+
+            if not Celebrity.exists(cursor, user_to_follow.user_id):
+                posts = Post.get_user_posts(cursor, user_to_follow.user_id, BACKFILL_POSTS_LIMIT)
+                Timeline.backfill(cursor, user_id, posts)
+            return construct_result()
+
+        return self.run_write(write)
 
     def handle_unfollow(self, request):
         username_to_unfollow = request.get('username_to_unfollow')
         if not username_to_unfollow:
             return construct_result(400, 'Bad request')
 
-        with Transaction() as tr:
+        user_id = self.context['user_id']
+
+        def write(cursor):
             try:
-                user_to_unfollow = User.read_by_name(tr.cursor, username_to_unfollow)
+                user_to_unfollow = User.read_by_name(cursor, username_to_unfollow)
             except ItemNotFoundError:
                 return construct_result(404, 'User not found')
 
             try:
-                follow = Follow.read_by_ids(tr.cursor, user_to_unfollow.user_id, self.context['user_id'])
+                follow = Follow.read_by_ids(cursor, user_to_unfollow.user_id, user_id)
             except ItemNotFoundError:
                 return construct_result(400, 'User already not followed')
 
-            follow.delete_me(tr.cursor)
+            follow.delete_me(cursor)
+            Timeline.prune(cursor, user_id, user_to_unfollow.user_id)
+            return construct_result()
 
-        return construct_result()
+        return self.run_write(write)
 
     def handle_like(self, request):
         post_id = request.get('post_id')
         if not post_id:
             return construct_result(400, 'Bad request')
 
-        with Transaction() as tr:
-            try:
-                post = Post.read_by_pk(tr.cursor, post_id)
-            except ItemNotFoundError:
+        user_id = self.context['user_id']
+        like_counter = self.like_counter
+
+        def write(cursor):
+            if not Post.exists(cursor, post_id):
                 return construct_result(404, 'Post not found')
 
-            post.likes += 1
-            post.update_me(tr.cursor)
+            if not Like(None, post_id, user_id).create_if_not_liked(cursor):
+                return construct_result(400, 'Post already liked')
 
-        return construct_result()
+            if like_counter is None:
+                Post.add_likes(cursor, ((post_id, 1),))
+            return construct_result()
+
+        after_commit = self.after_commit
+
+        def then(res):
+            if like_counter is not None and res['code'] == 200:
+                if after_commit is not None:
+                    after_commit.append(lambda: like_counter.add(post_id))
+                else:
+                    like_counter.add(post_id)
+            return res
+
+        return self.run_write(write, then)
 
     def handle_get_user_posts(self, request):
         username = request.get('username')
         if not username:
             return construct_result(400, 'Bad request')
 
-        with Transaction() as tr:
+        try:
+            limit, after = parse_page_params(request)
+        except (ValueError, TypeError, AttributeError):
+            return construct_result(400, 'Bad request')
+
+        with Transaction(READ) as tr:
             try:
                 user = User.read_by_name(tr.cursor, username)
             except ItemNotFoundError:
                 return construct_result(404, 'User not found')
 
-            posts = Post.get_user_posts(tr.cursor, user.user_id)
+            posts = Post.get_user_posts(tr.cursor, user.user_id, limit, after)
+            res = construct_posts_page_response(tr.cursor, posts, limit)
 
-        return construct_result(200, construct_posts_list_response(posts))
+        return construct_result(200, res)
 
     def handle_get_user_feed(self, request):
-        with Transaction() as tr:
-            posts = Post.get_user_feed(tr.cursor, self.context['user_id'])
+        try:
+            limit, after = parse_page_params(request)
+        except (ValueError, TypeError, AttributeError):
+            return construct_result(400, 'Bad request')
+
+        with Transaction(READ) as tr:
+            posts = Post.get_user_feed(tr.cursor, self.context['user_id'], limit, after)
+            res = construct_posts_page_response(tr.cursor, posts, limit)
 
-        return construct_result(200, construct_posts_list_response(posts))
+        return construct_result(200, res)
 
     def handle_get_followed_users(self, request):
         username = request.get('username')
         if not username:
             return construct_result(400, 'Bad request')
 
-        with Transaction() as tr:
+        with Transaction(READ) as tr:
             try:
                 user = User.read_by_name(tr.cursor, username)
             except ItemNotFoundError:
                 return construct_result(404, 'User not found')
 
             follows = Follow.get_followed_users(tr.cursor, user.user_id)
+            res = construct_follows_list_response(tr.cursor, follows)
 
-        return construct_result(200, construct_follows_list_response(follows))
+        return construct_result(200, res)
 
     def handle_get_following_users(self, request):
         username = request.get('username')
         if not username:
             return construct_result(400, 'Bad request')
 
-        with Transaction() as tr:
+        with Transaction(READ) as tr:
             try:
                 user = User.read_by_name(tr.cursor, username)
             except ItemNotFoundError:
                 return construct_result(404, 'User not found')
 
             follows = Follow.get_following_users(tr.cursor, user.user_id)
+            res = construct_follows_list_response(tr.cursor, follows, followers_mode=True)
 
-        return construct_result(200, construct_follows_list_response(follows, followers_mode=True))
+        return construct_result(200, res)
 
     def handle_admin_info(self, request):
-        with Transaction() as tr:
-            try:
-                user = User.read_by_pk(tr.cursor, self.context['user_id'])
-            except ItemNotFoundError:
-                return construct_result(404, 'User not found')
+        tables = request.get('tables') or list(ADMIN_TABLES)
+        if isinstance(tables, str):
+            tables = [table.strip() for table in tables.split(',') if table.strip()]
+        if not isinstance(tables, list) or any(table not in ADMIN_TABLES for table in tables):
+            return construct_result(400, 'Bad request')
+
+        stream = bool(request.get('stream'))
+        if stream and self.send_partial is None:
+            return construct_result(400, 'Streaming is not supported')
+
+        with Transaction(READ) as tr:
+            if stream:
+                counts = {}
+                for table in tables:
+                    model, _ = ADMIN_TABLES[table]
+                    counts[table] = 0
+                    for records in model.iter_all(tr.cursor, EXPORT_CHUNK_SIZE):
+                        self.send_partial({'table': table, 'rows': [record.to_dict() for record in records]})
+                        counts[table] += len(records)
+
+                return construct_result(200, {'counts': counts})
+
+            res = {}
+            for table in tables:
+                model, key = ADMIN_TABLES[table]
+                res[key] = [record.to_dict() for record in model.read_all(tr.cursor)]
+
+        return construct_result(200, res)
+
+    def handle_metrics(self, request):
+        return construct_result(200, metrics.snapshot())
+
+    def handle_batch(self, request):
+        requests = request.get('requests')
+        atomic = bool(request.get('atomic'))
+        allowed_types = BATCH_WRITE_TYPES if atomic else BATCH_TYPES
+        if not isinstance(requests, list) or not requests or len(requests) > MAX_BATCH_SIZE:
+            return construct_result(400, 'Bad request')
+        if any(not isinstance(sub_request, dict) or sub_request.get('type') not in allowed_types for sub_request in requests):
+            return construct_result(400, 'Bad request')
+
+        if atomic:
+            return self.handle_atomic_batch(requests)
 
-            if not user.is_admin:
-                return construct_result(403, 'Access denied')
-
-            users = User.read_all(tr.cursor)
-            posts = Post.read_all(tr.cursor)
-            follows = Follow.read_all(tr.cursor)
-
-        return construct_result(
-            200,
-            {
-                'users': [user.to_dict() for user in users],
-                'posts': [post.to_dict() for post in posts],
-                'folows': [follow.to_dict() for follow in follows],
-            }
-        )
+        # Sub-requests share the authentication of the batch, each of them runs as a separate request.
+        # Later sub-requests may read earlier writes, so each write waits for its commit here
+        results = []
+        defer_writes, self.defer_writes = self.defer_writes, False
+        try:
+            for sub_request in requests:
+                try:
+                    results.append(self.type_to_handler[sub_request['type']](sub_request))
+                except ServerBusyError:
+                    results.append(construct_result(503, 'Server is busy'))
+                except Exception as e:
+                    logging.exception('Unhandled exception during batch handling occured: {}'.format(e))
+                    results.append(construct_result(500, 'Error occured'))
+        finally:
+            self.defer_writes = defer_writes
+
+        return construct_result(200, {'results': results})
+
+    def handle_atomic_batch(self, requests):
+        results = []
+        self.after_commit = []
+        try:
+            with Transaction(WRITE) as tr:
+                self.batch_cursor = tr.cursor
+                for sub_request in requests:
+                    results.append(self.type_to_handler[sub_request['type']](sub_request))
+                    if results[-1]['code'] != 200:
+                        raise BatchAborted()
+        except BatchAborted:
+            # Everything is rolled back, results end with the sub-request that failed
+            return construct_result(400, {'results': results})
+        finally:
+            self.batch_cursor = None
+            after_commit, self.after_commit = self.after_commit, None
+
+        for func in after_commit:
+            func()
+
+        return construct_result(200, {'results': results})
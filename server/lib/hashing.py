@@ -0,0 +1,71 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+
+from lib.exceptions import ServerBusyError
+
+
+class HashPool:
+    def __init__(self, processes=0, max_concurrency=None, max_queue_size=64, max_threads=None):
+        self.processes = processes
+        self.max_concurrency = max_concurrency or processes or (os.cpu_count() or 1)
+        self.max_queue_size = max_queue_size
+        # Hashing and waiting for a slot both hold the caller's handler thread, so their total is capped
+        # below the handler thread count and a burst of signins cannot occupy every handler thread
+        self.max_pending = self.max_concurrency + self.max_queue_size
+        if max_threads is not None:
+            self.max_pending = min(self.max_pending, max_threads)
+
+        self.pool = None
+        if processes:
+            # Workers are started lazily; forking them would leak already accepted client sockets into the children.
+            self.pool = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context('spawn'))
+
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def pbkdf2(self, alg, password, salt, iterations, key_length):
+        with self._lock:
+            if self.waiting + self.running >= self.max_pending:
+                self.rejected += 1
+                raise ServerBusyError()
+            self.waiting += 1
+
+        self._slots.acquire()
+        with self._lock:
+            self.waiting -= 1
+            self.running += 1
+
+        try:
+            if self.pool is None:
+                return hashlib.pbkdf2_hmac(alg, password, salt, iterations, key_length)
+            return self.pool.submit(hashlib.pbkdf2_hmac, alg, password, salt, iterations, key_length).result()
+        finally:
+            self._slots.release()
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'processes': self.processes,
+                'max_concurrency': self.max_concurrency,
+                'max_queue_size': self.max_queue_size,
+                'max_pending': self.max_pending,
+                'waiting': self.waiting,
+                'running': self.running,
+                'completed': self.completed,
+                'rejected': self.rejected,
+            }
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
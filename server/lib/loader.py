@@ -0,0 +1,69 @@
+import csv
+import inspect
+import itertools
+import json
+import logging
+
+from lib.models.user import User
+from lib.models.post import Post
+from lib.models.follow import Follow
+
+
+MODELS = {
+    'users': User,
+    'posts': Post,
+    'follows': Follow,
+}
+
+
+def parse_value(column_type, value):
+    if value == '':
+        return None
+    if column_type == 'integer':
+        return int(value)
+    if column_type == 'boolean':
+        return value.lower() in ('1', 'true', 'yes')
+    return value
+
+
+def read_jsonl(file, model):
+    for line in file:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_csv(file, model):
+    column_types = dict(model.schema)
+    for row in csv.DictReader(file):
+        yield {column: parse_value(column_types.get(column), value) for column, value in row.items()}
+
+
+READERS = {
+    'jsonl': read_jsonl,
+    'csv': read_csv,
+}
+
+
+def defaulted_columns(model):
+    return {name for name, param in inspect.signature(model).parameters.items() if param.default is not param.empty}
+
+
+def drop_missing(row, defaults):
+    # Empty cells and nulls of columns with a default take the default instead of storing NULL (e.g. likes = likes + 1 on NULL stays NULL)
+    return {column: value for column, value in row.items() if value is not None or column not in defaults}
+
+
+def load_file(cursor, model, path, file_format, chunk_size):
+    loaded = 0
+    with open(path, newline='') as file:
+        rows = READERS[file_format](file, model)
+        defaults = defaulted_columns(model)
+        while True:
+            records = [model(**drop_missing(row, defaults)) for row in itertools.islice(rows, chunk_size)]
+            if not records:
+                return loaded
+
+            model.create_many(cursor, records)
+            loaded += len(records)
+            logging.info('Loaded {} rows into {}'.format(loaded, model.table))
@@ -1,37 +1,183 @@
+import logging
+
+from lib.cache import LRUCache
+from lib.loader import MODELS, READERS, load_file
+from lib.migrations import LATEST_DB_VERSION, migrate, rebuild_timelines, set_db_version
 from lib.server import Server
-from lib.transaction import Transaction
+from lib.supervisor import Supervisor
+from lib.transaction import Transaction, EXCLUSIVE, configure_pool
 
 from lib.models.user import User
 from lib.models.post import Post
 from lib.models.follow import Follow
+from lib.models.like import Like
+from lib.models.celebrity import Celebrity
+from lib.models.revoked_token import RevokedToken
+from lib.models.timeline import Timeline
+
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+
+def setup_logging(log_level):
+    logging.basicConfig()
+    logging.getLogger().setLevel(log_level)
+    handlers = logging.getLogger().handlers
+    if handlers:
+        handlers[0].setFormatter(logging.Formatter("%(asctime)s\t%(levelname)s\t%(process)d\t%(thread)d\t%(message)s"))
+
+
+def add_db_args(parser):
+    parser.add_argument('--db_path', default='small_twitter.db')
+    parser.add_argument('--db_timeout', type=float, default=5, help='Seconds to wait for a database lock')
+    parser.add_argument('--journal_mode', default='WAL', help='SQLite journal mode, WAL lets readers run concurrently with a writer')
+
+
+def setup_db(args):
+    configure_pool(args.db_path, journal_mode=args.journal_mode, timeout=args.db_timeout)
 
 
 def add_run_server_args(parser):
+    add_db_args(parser)
     parser.add_argument('--host', default='127.0.0.1')
     parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--idle_timeout', type=float, default=60, help='Seconds to keep an idle client connection open')
+    parser.add_argument('--max_request_size', type=int, default=1024 * 1024, help='Maximum size of a request in bytes, also after decompression; larger ones close the connection')
+    parser.add_argument('--handler_threads', type=int, default=None, help='Size of the thread pool running request handlers')
+    parser.add_argument('--max_queue_size', type=int, default=1024, help='Requests waiting for a handler thread before rejecting new ones')
+    parser.add_argument('--auth_processes', type=int, default=0, help='Size of the process pool for password hashing, 0 to hash in handler threads')
+    parser.add_argument('--auth_concurrency', type=int, default=None, help='Maximum number of passwords hashed at once, auth_processes or the number of CPUs by default')
+    parser.add_argument('--auth_queue_size', type=int, default=64, help='Signups and signins waiting for hashing before rejecting new ones, together with those hashing at most half of handler_threads')
+    parser.add_argument('--pbkdf2_iterations', type=int, default=100000, help='PBKDF2 iterations for new password keys, keys with fewer iterations are rehashed on signin')
+    parser.add_argument('--stats_interval', type=float, default=0, help='Seconds between server stats log lines, 0 to disable')
+    parser.add_argument('--user_cache_size', type=int, default=10000, help='Number of cached user records, 0 to disable the cache')
+    parser.add_argument('--user_cache_ttl', type=float, default=60, help='Seconds a cached user record stays valid')
+    parser.add_argument('--admin_claim_seconds', type=int, default=300, help='Seconds the admin role in an auth token is trusted before it is checked in the database')
+    parser.add_argument('--token_cache_size', type=int, default=10000, help='Number of cached verified auth tokens, 0 to disable the cache')
+    parser.add_argument('--like_flush_interval', type=float, default=0, help='Seconds to accumulate like counter increments before writing them, 0 to write every like immediately')
+    parser.add_argument('--metrics_port', type=int, default=0, help='Port serving metrics in Prometheus text format over HTTP, 0 to disable')
+    parser.add_argument('--request_log_sample', type=float, default=0, help='Fraction of requests logged with their type, size and latency, 0 to disable')
+    parser.add_argument('--write_batch_size', type=int, default=0, help='Maximum number of post/follow/unfollow/like requests committed in one transaction, 0 or 1 to commit each request separately')
+    parser.add_argument('--write_batch_delay', type=float, default=0.002, help='Seconds a write batch waits for more requests before committing')
+    parser.add_argument('--workers', type=int, default=1, help='Number of server processes sharing the port with SO_REUSEPORT')
+    parser.add_argument('--shutdown_timeout', type=float, default=30, help='Seconds to wait for requests in flight on SIGTERM or SIGINT')
+
+
+def create_server(args, **kwargs):
+    setup_db(args)
+    User.cache = LRUCache(args.user_cache_size, args.user_cache_ttl) if args.user_cache_size > 0 else None
+    server_kwargs = dict(
+        idle_timeout=args.idle_timeout,
+        max_request_size=args.max_request_size,
+        revocation_ttl=args.user_cache_ttl,
+        handler_threads=args.handler_threads,
+        max_queue_size=args.max_queue_size,
+        auth_processes=args.auth_processes,
+        auth_concurrency=args.auth_concurrency,
+        auth_queue_size=args.auth_queue_size,
+        pbkdf2_iterations=args.pbkdf2_iterations,
+        stats_interval=args.stats_interval,
+        token_cache_size=args.token_cache_size,
+        admin_claim_seconds=args.admin_claim_seconds,
+        like_flush_interval=args.like_flush_interval,
+        metrics_port=args.metrics_port,
+        request_log_sample=args.request_log_sample,
+        shutdown_timeout=args.shutdown_timeout,
+        write_batch_size=args.write_batch_size,
+        write_batch_delay=args.write_batch_delay,
+    )
+    server_kwargs.update(kwargs)
+    return Server(args.host, args.port, **server_kwargs)
+
+
+def run_worker(args, worker_id, reports):
+    # Runs in a spawned process, nothing is inherited from the supervisor
+    reports.cancel_join_thread()
+    setup_logging(args.log_level)
+    # Stats and metrics of all workers are aggregated by the supervisor
+    create_server(args, stats_interval=0, metrics_port=0, reuse_port=True, worker_id=worker_id, reports=reports).start()
 
 
 def run_server_main(args):
-    Server(args.host, args.port).start()
+    if args.workers > 1:
+        setup_db(args)
+        Supervisor(
+            run_worker,
+            args,
+            args.workers,
+            host=args.host,
+            stats_interval=args.stats_interval,
+            metrics_port=args.metrics_port,
+            shutdown_timeout=args.shutdown_timeout,
+        ).start()
+        return
+
+    create_server(args).start()
 
 
 def add_init_db_args(parser):
+    add_db_args(parser)
     parser.add_argument('--force', action='store_true', default=False)
 
 
 def init_db_main(args):
+    setup_db(args)
     with Transaction() as tr:
         User.init_db(tr.cursor, args.force)
         Post.init_db(tr.cursor, args.force)
         Follow.init_db(tr.cursor, args.force)
+        Celebrity.init_db(tr.cursor, args.force)
+        Timeline.init_db(tr.cursor, args.force)
+        Like.init_db(tr.cursor, args.force)
+        RevokedToken.init_db(tr.cursor, args.force)
+        set_db_version(tr.cursor, LATEST_DB_VERSION)
+
+
+def add_migrate_db_args(parser):
+    add_db_args(parser)
+
+
+def migrate_db_main(args):
+    setup_db(args)
+    with Transaction(EXCLUSIVE) as tr:
+        migrate(tr.cursor)
+
+
+def add_load_db_args(parser):
+    add_db_args(parser)
+    for table in MODELS:
+        parser.add_argument('--{}'.format(table), action='append', default=[], metavar='PATH', help='JSONL or CSV file with {} to load, can be repeated'.format(table))
+    parser.add_argument('--format', choices=list(READERS), default=None, help='Input format, detected by file extension if not set')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='Rows inserted per executemany call')
+    parser.add_argument('--rebuild_timelines', action='store_true', help='Recompute timelines of all users after loading, needed for loaded posts and follows to appear in feeds')
+
+
+def load_db_main(args):
+    setup_db(args)
+    # One transaction for the whole load: it is much faster than committing per chunk and a failed load leaves nothing behind
+    with Transaction(EXCLUSIVE) as tr:
+        for table, model in MODELS.items():
+            for path in getattr(args, table):
+                file_format = args.format or path.rsplit('.', 1)[-1].lower()
+                if file_format not in READERS:
+                    raise ValueError('Unknown format of {}, pass --format'.format(path))
+                load_file(tr.cursor, model, path, file_format, args.chunk_size)
+
+        # Loaded posts and follows bypass fan-out. Rebuilding covers the whole database, so it is only done on request
+        if args.rebuild_timelines:
+            rebuild_timelines(tr.cursor)
+        elif args.posts or args.follows:
+            logging.warning('Loaded posts and follows are not in timelines yet, load with --rebuild_timelines to recompute them')
 
 
 def add_modify_admins_args(parser):
+    add_db_args(parser)
     parser.add_argument('--username', required=True)
     parser.add_argument('--new_role', default='admin', help='Pass "admin" if you want to make user admin and anything else otherwise')
 
 
 def modify_admins_main(args):
+    setup_db(args)
     with Transaction() as tr:
         user = User.read_by_name(tr.cursor, args.username)
         user.is_admin = args.new_role == 'admin'
@@ -0,0 +1,226 @@
+import bisect
+import collections
+import functools
+import logging
+import threading
+import time
+
+
+# Upper bounds of histogram buckets in seconds, the last bucket is unbounded
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUANTILES = (50, 95, 99)
+PROMETHEUS_PREFIX = 'small_twitter'
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def merge(self, counts, count, total):
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.count += count
+        self.sum += total
+
+    def cumulative(self):
+        res = []
+        total = 0
+        for count in self.counts:
+            total += count
+            res.append(total)
+        return res
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the quantile, the overflow bucket reports the largest finite bound
+        if not self.count:
+            return 0
+        rank = self.count * q / 100
+        for bound, total in zip(self.buckets, self.cumulative()):
+            if total >= rank:
+                return bound
+        return self.buckets[-1]
+
+    def to_dict(self):
+        res = {'count': self.count, 'sum': self.sum}
+        for q in QUANTILES:
+            res['p{}'.format(q)] = self.quantile(q)
+        return res
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.histograms = collections.defaultdict(dict)
+        self.responses = collections.defaultdict(collections.Counter)
+        self.in_flight = 0
+        self.sources = {}
+
+    # Time spent in the current thread is accumulated per kind between begin() and end(),
+    # so code deep below the handler (transactions, auth) does not have to know the request type
+    def begin(self):
+        self._local.timings = {}
+
+    def end(self):
+        timings = getattr(self._local, 'timings', None)
+        self._local.timings = None
+        return timings or {}
+
+    def add(self, kind, seconds):
+        timings = getattr(self._local, 'timings', None)
+        if timings is not None:
+            timings[kind] = timings.get(kind, 0) + seconds
+
+    def timed(self, kind):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.add(kind, time.perf_counter() - started)
+            return wrapper
+        return decorator
+
+    def observe(self, name, label, seconds):
+        with self._lock:
+            histogram = self.histograms[name].get(label)
+            if histogram is None:
+                histogram = self.histograms[name][label] = Histogram()
+            histogram.observe(seconds)
+
+    def count_response(self, label, code):
+        with self._lock:
+            self.responses[label][code] += 1
+
+    def change_in_flight(self, delta):
+        with self._lock:
+            self.in_flight += delta
+
+    def add_source(self, name, func):
+        self.sources[name] = func
+
+    def snapshot(self):
+        with self._lock:
+            res = {
+                'in_flight': self.in_flight,
+                'histograms': {
+                    name: {label: histogram.to_dict() for label, histogram in histograms.items()}
+                    for name, histograms in self.histograms.items()
+                },
+                'responses': {label: {str(code): count for code, count in codes.items()} for label, codes in self.responses.items()},
+            }
+        for name, func in self.sources.items():
+            res[name] = func()
+        return res
+
+    # Raw state of the metrics of one process, a supervisor merges the states of its workers into one Metrics
+    def export_state(self):
+        with self._lock:
+            state = {
+                'in_flight': self.in_flight,
+                'histograms': {
+                    name: {label: (histogram.counts, histogram.count, histogram.sum) for label, histogram in histograms.items()}
+                    for name, histograms in self.histograms.items()
+                },
+                'responses': {label: dict(codes) for label, codes in self.responses.items()},
+            }
+        state['sources'] = {name: func() for name, func in self.sources.items()}
+        return state
+
+    def merge_state(self, state):
+        with self._lock:
+            self.in_flight += state['in_flight']
+            for name, histograms in state['histograms'].items():
+                for label, (counts, count, total) in histograms.items():
+                    histogram = self.histograms[name].get(label)
+                    if histogram is None:
+                        histogram = self.histograms[name][label] = Histogram()
+                    histogram.merge(counts, count, total)
+            for label, codes in state['responses'].items():
+                self.responses[label].update(codes)
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            lines.append('# TYPE {}_in_flight gauge'.format(PROMETHEUS_PREFIX))
+            lines.append('{}_in_flight {}'.format(PROMETHEUS_PREFIX, self.in_flight))
+
+            for name, histograms in sorted(self.histograms.items()):
+                metric = '{}_{}_seconds'.format(PROMETHEUS_PREFIX, name)
+                lines.append('# TYPE {} histogram'.format(metric))
+                for label, histogram in sorted(histograms.items()):
+                    for bound, total in zip(self.bucket_labels(histogram), histogram.cumulative()):
+                        lines.append('{}_bucket{{type="{}",le="{}"}} {}'.format(metric, label, bound, total))
+                    lines.append('{}_sum{{type="{}"}} {}'.format(metric, label, histogram.sum))
+                    lines.append('{}_count{{type="{}"}} {}'.format(metric, label, histogram.count))
+
+            metric = '{}_responses_total'.format(PROMETHEUS_PREFIX)
+            lines.append('# TYPE {} counter'.format(metric))
+            for label, codes in sorted(self.responses.items()):
+                for code, count in sorted(codes.items(), key=lambda item: str(item[0])):
+                    lines.append('{}{{type="{}",code="{}"}} {}'.format(metric, label, code, count))
+
+        for name, func in sorted(self.sources.items()):
+            for key, value in flatten(func(), '{}_{}'.format(PROMETHEUS_PREFIX, name)):
+                lines.append('# TYPE {} gauge'.format(key))
+                lines.append('{} {}'.format(key, value))
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def bucket_labels(histogram):
+        return [str(bound) for bound in histogram.buckets] + ['+Inf']
+
+
+async def handle_prometheus_scrape(get_metrics, reader, writer):
+    # Minimal HTTP responder for Prometheus: every request gets the text exposition of current metrics
+    try:
+        while (await reader.readline()).strip():
+            pass
+        body = get_metrics().prometheus_text().encode()
+        writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        await writer.drain()
+    except ConnectionError as e:
+        logging.warning('Metrics scrape failed: {}'.format(e))
+    finally:
+        writer.close()
+
+
+def sum_stats(stats):
+    # Numbers are summed across processes except max_* values, which stay the maximum
+    stats = [item for item in stats if item is not None]
+    if not stats:
+        return None
+    if all(isinstance(item, dict) for item in stats):
+        keys = dict.fromkeys(key for item in stats for key in item)
+        res = {}
+        for key in keys:
+            values = [item.get(key) for item in stats]
+            if str(key).startswith('max_') and all(isinstance(value, (int, float)) for value in values if value is not None):
+                res[key] = max((value for value in values if value is not None), default=None)
+            else:
+                res[key] = sum_stats(values)
+        return res
+    if all(isinstance(item, (int, float)) and not isinstance(item, bool) for item in stats):
+        return sum(stats)
+    return stats[0]
+
+
+def flatten(stats, prefix):
+    if isinstance(stats, dict):
+        for key, value in stats.items():
+            yield from flatten(value, '{}_{}'.format(prefix, key))
+    elif isinstance(stats, (int, float)) and not isinstance(stats, bool):
+        yield prefix, stats
+
+
+metrics = Metrics()
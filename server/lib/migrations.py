@@ -0,0 +1,111 @@
+import logging
+
+from lib.models.user import User
+from lib.models.post import Post
+from lib.models.follow import Follow
+from lib.models.like import Like
+from lib.models.celebrity import Celebrity
+from lib.models.revoked_token import RevokedToken
+from lib.models.timeline import Timeline, BACKFILL_POSTS_LIMIT, FANOUT_FOLLOWERS_LIMIT
+
+
+FILL_CELEBRITIES_QUERY = '''
+    INSERT INTO {celebrities} (user_id)
+    SELECT user_id
+    FROM {follows}
+    GROUP BY user_id
+    HAVING COUNT(*) > ?
+'''
+
+# Like a follow, every follower gets only the latest BACKFILL_POSTS_LIMIT posts of each followed author;
+# posts are ranked once per author, walking the posts_user_id_timestamp_post_id index
+FILL_TIMELINES_QUERY = '''
+    INSERT INTO {timelines} (entry_id, user_id, post_id, author_id, timestamp)
+    SELECT lower(hex(randomblob(16))), f.follower_id, p.post_id, p.user_id, p.timestamp
+    FROM {follows} AS f
+    INNER JOIN (
+        SELECT post_id, user_id, timestamp,
+            ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY timestamp DESC, post_id DESC) AS position
+        FROM {posts}
+    ) AS p
+    ON p.user_id = f.user_id
+    WHERE p.position <= ? AND f.user_id NOT IN (SELECT user_id FROM {celebrities})
+'''
+
+
+def get_db_version(cursor):
+    cursor.execute('PRAGMA user_version')
+    return cursor.fetchone()[0]
+
+
+def set_db_version(cursor, version):
+    cursor.execute('PRAGMA user_version = {}'.format(int(version)))
+
+
+def rebuild_table(cursor, model):
+    old_table = '{}_old'.format(model.table)
+    for index_name, _, _ in model.indexes:
+        cursor.execute('DROP INDEX IF EXISTS {}'.format(index_name))
+    cursor.execute('ALTER TABLE {} RENAME TO {}'.format(model.table, old_table))
+
+    model.init_db(cursor)
+
+    # Rows violating the new primary key or unique constraints are duplicates, keep the oldest one
+    columns = ', '.join(column for column, _ in model.schema)
+    cursor.execute('INSERT OR IGNORE INTO {} ({}) SELECT {} FROM {} ORDER BY rowid'.format(model.table, columns, columns, old_table))
+    cursor.execute('DROP TABLE {}'.format(old_table))
+
+
+def add_keys_and_indexes(cursor):
+    for model in (User, Post, Follow):
+        rebuild_table(cursor, model)
+
+
+def add_posts_pagination_index(cursor):
+    cursor.execute('DROP INDEX IF EXISTS posts_user_id_timestamp')
+    Post.init_indexes(cursor)
+
+
+def rebuild_timelines(cursor):
+    tables = {'celebrities': Celebrity.table, 'follows': Follow.table, 'timelines': Timeline.table, 'posts': Post.table}
+
+    cursor.execute('DELETE FROM {}'.format(Celebrity.table))
+    cursor.execute('DELETE FROM {}'.format(Timeline.table))
+    cursor.execute(FILL_CELEBRITIES_QUERY.format(**tables), (FANOUT_FOLLOWERS_LIMIT,))
+    cursor.execute(FILL_TIMELINES_QUERY.format(**tables), (BACKFILL_POSTS_LIMIT,))
+
+
+def add_timelines(cursor):
+    Celebrity.init_db(cursor)
+    Timeline.init_db(cursor)
+    rebuild_timelines(cursor)
+
+
+def add_likes(cursor):
+    Like.init_db(cursor)
+
+
+def add_revoked_tokens(cursor):
+    RevokedToken.init_db(cursor)
+
+
+MIGRATIONS = (
+    (1, add_keys_and_indexes),
+    (2, add_posts_pagination_index),
+    (3, add_timelines),
+    (4, add_likes),
+    (5, add_revoked_tokens),
+)
+
+LATEST_DB_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(cursor):
+    version = get_db_version(cursor)
+    for migration_version, migration in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        logging.info('Migrating database to version {} ({})'.format(migration_version, migration.__name__))
+        migration(cursor)
+        set_db_version(cursor, migration_version)
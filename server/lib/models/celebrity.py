@@ -0,0 +1,21 @@
+from lib.models.record import MetaRecord
+from lib.exceptions import ItemNotFoundError
+
+
+class Celebrity(metaclass=MetaRecord):
+    table = 'celebrities'
+    primary_key = 'user_id'
+    schema = (
+        ('user_id', 'text'),
+    )
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    @classmethod
+    def exists(cls, cursor, user_id):
+        try:
+            cls.read_by_pk(cursor, user_id)
+        except ItemNotFoundError:
+            return False
+        return True
@@ -34,6 +34,10 @@ class Follow(metaclass=MetaRecord):
         ('user_id', 'text'),
         ('follower_id', 'text'),
     )
+    indexes = (
+        ('follows_user_id_follower_id', ('user_id', 'follower_id'), True),
+        ('follows_follower_id_user_id', ('follower_id', 'user_id'), False),
+    )
 
     def __init__(self, follow_id, user_id, follower_id):
         self.follow_id = follow_id or str(uuid.uuid4())
@@ -46,14 +50,14 @@ class Follow(metaclass=MetaRecord):
         res = cursor.fetchone()
         if res is None:
             raise ItemNotFoundError()
-        return cls(*res)
+        return cls.from_row(res)
 
     @classmethod
     def get_following_users(cls, cursor, user_id):
         cursor.execute(GET_FOLLOWING_USERS_QUERY.format(Follow.table), (user_id,))
-        return [cls(*row) for row in cursor.fetchall()]
+        return [cls.from_row(row) for row in cursor.fetchall()]
 
     @classmethod
     def get_followed_users(cls, cursor, follower_id):
         cursor.execute(GET_FOLLOWED_USERS_QUERY.format(Follow.table), (follower_id,))
-        return [cls(*row) for row in cursor.fetchall()]
+        return [cls.from_row(row) for row in cursor.fetchall()]
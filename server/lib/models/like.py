@@ -0,0 +1,31 @@
+import uuid
+
+from lib.models.record import MetaRecord
+
+
+INSERT_IF_NOT_LIKED_QUERY = '''
+    INSERT OR IGNORE INTO {} (like_id, post_id, user_id)
+    VALUES (?, ?, ?)
+'''
+
+
+class Like(metaclass=MetaRecord):
+    table = 'likes'
+    primary_key = 'like_id'
+    schema = (
+        ('like_id', 'text'),
+        ('post_id', 'text'),
+        ('user_id', 'text'),
+    )
+    indexes = (
+        ('likes_post_id_user_id', ('post_id', 'user_id'), True),
+    )
+
+    def __init__(self, like_id, post_id, user_id):
+        self.like_id = like_id or str(uuid.uuid4())
+        self.post_id = post_id
+        self.user_id = user_id
+
+    def create_if_not_liked(self, cursor):
+        cursor.execute(INSERT_IF_NOT_LIKED_QUERY.format(Like.table), (self.like_id, self.post_id, self.user_id))
+        return cursor.rowcount == 1
@@ -3,31 +3,73 @@ import uuid
 from lib.exceptions import ItemNotFoundError
 
 from lib.models.record import MetaRecord
+from lib.models.celebrity import Celebrity
 from lib.models.follow import Follow
+from lib.models.timeline import Timeline
+
+
+FIRST_PAGE = (2 ** 63 - 1, '')
 
 
 GET_USER_POSTS_QUERY = '''
     SELECT *
     FROM {}
     WHERE user_id = ?
-    ORDER BY timestamp DESC
+    AND (timestamp, post_id) < (?, ?)
+    ORDER BY timestamp DESC, post_id DESC
+    LIMIT ?
 '''
 
 GET_USER_FEED_QUERY = '''
-    SELECT
-        p.user_id,
-        p.post_id,
-        p.post,
-        p.timestamp,
-        p.likes
-    FROM {} AS p
-    INNER JOIN (
-        SELECT user_id
-        FROM {}
-        WHERE follower_id = ?
-    ) AS f
-    ON p.user_id = f.user_id
-    ORDER BY timestamp DESC
+    SELECT *
+    FROM (
+        SELECT
+            p.user_id,
+            p.post_id,
+            p.post,
+            p.timestamp,
+            p.likes
+        FROM {timelines} AS t
+        INNER JOIN {posts} AS p
+        ON p.post_id = t.post_id
+        WHERE t.user_id = :user_id
+        AND (t.timestamp, t.post_id) < (:timestamp, :post_id)
+        ORDER BY t.timestamp DESC, t.post_id DESC
+        LIMIT :limit
+    )
+    UNION
+    SELECT *
+    FROM (
+        SELECT
+            p.user_id,
+            p.post_id,
+            p.post,
+            p.timestamp,
+            p.likes
+        FROM {follows} AS f
+        INNER JOIN {celebrities} AS c
+        ON c.user_id = f.user_id
+        INNER JOIN {posts} AS p
+        ON p.user_id = f.user_id
+        WHERE f.follower_id = :user_id
+        AND (p.timestamp, p.post_id) < (:timestamp, :post_id)
+        ORDER BY p.timestamp DESC, p.post_id DESC
+        LIMIT :limit
+    )
+    ORDER BY timestamp DESC, post_id DESC
+    LIMIT :limit
+'''
+
+ADD_LIKES_QUERY = '''
+    UPDATE {}
+    SET likes = likes + ?
+    WHERE post_id = ?
+'''
+
+EXISTS_QUERY = '''
+    SELECT 1
+    FROM {}
+    WHERE post_id = ?
 '''
 
 
@@ -41,6 +83,9 @@ class Post(metaclass=MetaRecord):
         ('timestamp', 'integer'),
         ('likes', 'integer'),
     )
+    indexes = (
+        ('posts_user_id_timestamp_post_id', ('user_id', 'timestamp DESC', 'post_id DESC'), False),
+    )
 
     def __init__(self, user_id, post_id, post, timestamp, likes=0):
         self.user_id = user_id
@@ -50,11 +95,22 @@ class Post(metaclass=MetaRecord):
         self.likes = likes
 
     @classmethod
-    def get_user_posts(cls, cursor, user_id):
-        cursor.execute(GET_USER_POSTS_QUERY.format(Post.table), (user_id,))
-        return [cls(*row) for row in cursor.fetchall()]
+    def get_user_posts(cls, cursor, user_id, limit, after=None):
+        cursor.execute(GET_USER_POSTS_QUERY.format(Post.table), (user_id, *(after or FIRST_PAGE), limit))
+        return [cls.from_row(row) for row in cursor.fetchall()]
+
+    @classmethod
+    def get_user_feed(cls, cursor, user_id, limit, after=None):
+        query = GET_USER_FEED_QUERY.format(posts=Post.table, follows=Follow.table, timelines=Timeline.table, celebrities=Celebrity.table)
+        timestamp, post_id = after or FIRST_PAGE
+        cursor.execute(query, {'user_id': user_id, 'timestamp': timestamp, 'post_id': post_id, 'limit': limit})
+        return [cls.from_row(row) for row in cursor.fetchall()]
+
+    @classmethod
+    def exists(cls, cursor, post_id):
+        cursor.execute(EXISTS_QUERY.format(Post.table), (post_id,))
+        return cursor.fetchone() is not None
 
     @classmethod
-    def get_user_feed(cls, cursor, user_id):
-        cursor.execute(GET_USER_FEED_QUERY.format(Post.table, Follow.table), (user_id,))
-        return [cls(*row) for row in cursor.fetchall()]
+    def add_likes(cls, cursor, post_likes):
+        cursor.executemany(ADD_LIKES_QUERY.format(Post.table), ((likes, post_id) for post_id, likes in post_likes))
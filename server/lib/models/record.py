@@ -1,66 +1,242 @@
 import functools
+import operator
 
 from lib.exceptions import ItemNotFoundError
+from lib.transaction import after_transaction, current_cache_version
 
 
-@staticmethod
-def init_db(table, schema, cursor, force=False):
-    query = 'CREATE TABLE {} ({})'.format(table, ', '.join(' '.join((column, column_type)) for column, column_type in schema))
+READ_BY_PKS_CHUNK_SIZE = 500
+
+
+def column_definition(column, column_type, primary_key):
+    if column == primary_key:
+        return '{} {} PRIMARY KEY'.format(column, column_type)
+    return '{} {}'.format(column, column_type)
+
+
+def init_db(table, schema, primary_key, indexes, cursor, force=False):
+    query = 'CREATE TABLE {} ({})'.format(table, ', '.join(column_definition(column, column_type, primary_key) for column, column_type in schema))
     if force:
         cursor.execute('DROP TABLE IF EXISTS {}'.format(table))
     cursor.execute(query)
+    init_indexes(table, indexes, cursor)
+
+
+def init_indexes(table, indexes, cursor):
+    for index_name, columns, unique in indexes:
+        query = 'CREATE {}INDEX IF NOT EXISTS {} ON {} ({})'.format('UNIQUE ' if unique else '', index_name, table, ', '.join(columns))
+        cursor.execute(query)
+
+
+# Per-row helpers are plain closures rather than partialmethods, they run for every row of every list response
+def make_to_dict(columns):
+    def to_dict(self):
+        return {column: getattr(self, column) for column in columns}
+    return to_dict
+
+
+def make_to_row(columns):
+    getter = operator.attrgetter(*columns)
+    if len(columns) == 1:
+        return lambda self: (getter(self),)
+    return lambda self: getter(self)
+
+
+@classmethod
+def from_row(cls, row):
+    record = cls(*row)
+    # Snapshot of the stored values, update_me writes only the columns that differ from it
+    record._row = row
+    return record
+
+
+def dirty_columns(self, columns, primary_key):
+    row = getattr(self, '_row', None)
+    values = self.to_row()
+    return tuple(
+        column for i, column in enumerate(columns)
+        if column != primary_key and (row is None or values[i] != row[i])
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def update_query(table, columns, primary_key):
+    return 'UPDATE {} SET {} WHERE {} = ?'.format(table, ', '.join('{} = ?'.format(column) for column in columns), primary_key)
+
+
+@functools.lru_cache(maxsize=None)
+def read_by_pks_query(table, primary_key, count):
+    return 'SELECT * FROM {} WHERE {} IN ({})'.format(table, primary_key, ', '.join(['?'] * count))
+
+
+@classmethod
+def read_cached(cls, column, value):
+    if cls.cache is None:
+        return None
+    row = cls.cache.get((column, value))
+    return cls.from_row(row) if row is not None else None
 
 
-def to_dict(self, schema):
-    return {column: getattr(self, column) for column, _ in schema}
+@classmethod
+def cache_row(cls, cache_key_positions, row):
+    if cls.cache is None:
+        return
+    # The transaction's snapshot may predate a commit whose invalidation already ran, such a row must not be cached
+    version = current_cache_version()
+    for column, position in cache_key_positions:
+        cls.cache.put((column, row[position]), row, version=version)
+
+
+def invalidate_cached(self):
+    # Cache keys are expected to be immutable columns, so the current values also address the cached row.
+    # Invalidation runs after COMMIT, so readers cannot cache the old row before the commit, and cache_row skips
+    # rows read by transactions started before it; after a rollback the entry is dropped as well,
+    # since reads inside the transaction could have cached uncommitted rows
+    if self.cache is not None:
+        cache = self.cache
+        keys = [(column, getattr(self, column)) for column in self.cache_keys]
+        after_transaction(lambda: cache.invalidate(*keys))
+
+
+def invalidate_cached_many(cls, records):
+    # One callback for the whole chunk, bulk loads would otherwise queue one per row
+    if cls.cache is not None:
+        cache = cls.cache
+        keys = [(column, getattr(record, column)) for record in records for column in cls.cache_keys]
+        after_transaction(lambda: cache.invalidate(*keys))
+
 
+def create_me(self, query, cursor):
+    row = self.to_row()
+    cursor.execute(query, row)
+    self._row = row
+    self.invalidate_cached()
 
-def create_me(self, table, schema, cursor):
-    query = 'INSERT INTO {} VALUES ({})'.format(table, ', '.join(['?'] * len(schema)))
-    cursor.execute(query, [getattr(self, column) for column, _ in self.schema])
 
+def update_me(self, table, primary_key, cursor):
+    columns = self.dirty_columns()
+    if not columns:
+        return
 
-def update_me(self, table, schema, primary_key, cursor):
-    query = 'UPDATE {} SET {} WHERE {} = ?'.format(table, ', '.join('{} = ?'.format(column) for column, _ in schema), primary_key)
-    cursor.execute(query, [getattr(self, column) for column, _ in self.schema] + [getattr(self, primary_key)])
+    cursor.execute(update_query(table, columns, primary_key), [getattr(self, column) for column in columns] + [getattr(self, primary_key)])
+    self._row = self.to_row()
+    self.invalidate_cached()
 
 
-def delete_me(self, table, primary_key, cursor):
-    query = 'DELETE FROM {} WHERE {} = ?'.format(table, primary_key)
+def delete_me(self, query, primary_key, cursor):
     cursor.execute(query, (getattr(self, primary_key),))
+    self.invalidate_cached()
+
+
+@classmethod
+def create_many(cls, query, cursor, records):
+    records = list(records)
+    rows = [record.to_row() for record in records]
+    cursor.executemany(query, rows)
+    for record, row in zip(records, rows):
+        record._row = row
+    invalidate_cached_many(cls, records)
+
+
+@classmethod
+def delete_many(cls, query, primary_key, cursor, records):
+    records = list(records)
+    cursor.executemany(query, [(getattr(record, primary_key),) for record in records])
+    invalidate_cached_many(cls, records)
 
 
 @classmethod
-def read_by_pk(cls, table, primary_key, cursor, primary_key_value):
-    query = 'SELECT * FROM {} WHERE {} = ?'.format(table, primary_key)
+def read_by_pk(cls, query, primary_key, cursor, primary_key_value):
+    cached = cls.read_cached(primary_key, primary_key_value)
+    if cached is not None:
+        return cached
+
     cursor.execute(query, (primary_key_value,))
     res = cursor.fetchone()
     if res is None:
         raise ItemNotFoundError()
-    return cls(*res)
+    cls.cache_row(res)
+    return cls.from_row(res)
+
+
+@classmethod
+def read_by_pks(cls, table, primary_key, cursor, primary_key_values):
+    res = []
+    missing = []
+    for primary_key_value in set(primary_key_values):
+        cached = cls.read_cached(primary_key, primary_key_value)
+        if cached is not None:
+            res.append(cached)
+        else:
+            missing.append(primary_key_value)
+
+    for i in range(0, len(missing), READ_BY_PKS_CHUNK_SIZE):
+        chunk = missing[i:i + READ_BY_PKS_CHUNK_SIZE]
+        cursor.execute(read_by_pks_query(table, primary_key, len(chunk)), chunk)
+        for row in cursor.fetchall():
+            cls.cache_row(row)
+            res.append(cls.from_row(row))
+    return res
 
 
 @classmethod
-def read_all(cls, table, cursor):
-    query = 'SELECT * FROM {}'.format(table)
+def read_all(cls, query, cursor):
     cursor.execute(query)
-    return [cls(*row) for row in cursor.fetchall()]
+    return [cls.from_row(row) for row in cursor.fetchall()]
+
+
+@classmethod
+def iter_all(cls, query, cursor, chunk_size):
+    cursor.execute(query)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield [cls.from_row(row) for row in rows]
 
 
 class MetaRecord(type):
     def __new__(cls, name, bases, dct):
+        columns = tuple(column for column, _ in dct['schema'])
+        if '__slots__' not in dct:
+            dct['__slots__'] = columns + ('_row',)
+
         inst = super().__new__(cls, name, bases, dct)
 
         table = inst.table
         schema = inst.schema
         primary_key = inst.primary_key
-
-        inst.init_db = functools.partialmethod(init_db, table, schema)
-        inst.to_dict = functools.partialmethod(to_dict, schema)
-        inst.create_me = functools.partialmethod(create_me, table, schema)
-        inst.update_me = functools.partialmethod(update_me, table, schema, primary_key)
-        inst.delete_me = functools.partialmethod(delete_me, table, primary_key)
-        inst.read_by_pk = functools.partialmethod(read_by_pk, table, primary_key)
-        inst.read_all = functools.partialmethod(read_all, table)
+        indexes = getattr(inst, 'indexes', ())
+
+        if not hasattr(inst, 'cache'):
+            inst.cache = None
+        if not hasattr(inst, 'cache_keys'):
+            inst.cache_keys = (primary_key,)
+
+        cache_key_positions = tuple((column, columns.index(column)) for column in inst.cache_keys)
+
+        insert_query = 'INSERT INTO {} VALUES ({})'.format(table, ', '.join(['?'] * len(columns)))
+        delete_query = 'DELETE FROM {} WHERE {} = ?'.format(table, primary_key)
+        read_by_pk_query = 'SELECT * FROM {} WHERE {} = ?'.format(table, primary_key)
+        read_all_query = 'SELECT * FROM {}'.format(table)
+
+        inst.init_db = functools.partialmethod(staticmethod(init_db), table, schema, primary_key, indexes)
+        inst.init_indexes = functools.partialmethod(staticmethod(init_indexes), table, indexes)
+        inst.to_dict = make_to_dict(columns)
+        inst.to_row = make_to_row(columns)
+        inst.from_row = from_row
+        inst.dirty_columns = functools.partialmethod(dirty_columns, columns, primary_key)
+        inst.read_cached = read_cached
+        inst.cache_row = functools.partialmethod(cache_row, cache_key_positions)
+        inst.invalidate_cached = invalidate_cached
+        inst.create_me = functools.partialmethod(create_me, insert_query)
+        inst.update_me = functools.partialmethod(update_me, table, primary_key)
+        inst.delete_me = functools.partialmethod(delete_me, delete_query, primary_key)
+        inst.create_many = functools.partialmethod(create_many, insert_query)
+        inst.delete_many = functools.partialmethod(delete_many, delete_query, primary_key)
+        inst.read_by_pk = functools.partialmethod(read_by_pk, read_by_pk_query, primary_key)
+        inst.read_by_pks = functools.partialmethod(read_by_pks, table, primary_key)
+        inst.read_all = functools.partialmethod(read_all, read_all_query)
+        inst.iter_all = functools.partialmethod(iter_all, read_all_query)
 
         return inst
@@ -0,0 +1,43 @@
+from lib.models.record import MetaRecord
+from lib.exceptions import ItemNotFoundError
+
+
+INSERT_IF_NOT_REVOKED_QUERY = '''
+    INSERT OR IGNORE INTO {} (jti, expires)
+    VALUES (?, ?)
+'''
+
+DELETE_EXPIRED_QUERY = '''
+    DELETE FROM {}
+    WHERE expires < ?
+'''
+
+
+class RevokedToken(metaclass=MetaRecord):
+    table = 'revoked_tokens'
+    primary_key = 'jti'
+    schema = (
+        ('jti', 'text'),
+        ('expires', 'integer'),
+    )
+    indexes = (
+        ('revoked_tokens_expires', ('expires',), False),
+    )
+
+    def __init__(self, jti, expires):
+        self.jti = jti
+        self.expires = expires
+
+    @classmethod
+    def exists(cls, cursor, jti):
+        try:
+            cls.read_by_pk(cursor, jti)
+        except ItemNotFoundError:
+            return False
+        return True
+
+    @classmethod
+    def revoke(cls, cursor, jti, expires, now):
+        # Expired tokens are rejected by their signature check anyway, so they are dropped from the list
+        cursor.execute(DELETE_EXPIRED_QUERY.format(RevokedToken.table), (now,))
+        cursor.execute(INSERT_IF_NOT_REVOKED_QUERY.format(RevokedToken.table), (jti, expires))
@@ -0,0 +1,82 @@
+import uuid
+
+from lib.models.record import MetaRecord
+from lib.models.celebrity import Celebrity
+from lib.models.follow import Follow
+
+
+# Posts of users with more followers than this are not copied into timelines but merged into feeds at read time
+FANOUT_FOLLOWERS_LIMIT = 5000
+
+# Number of most recent posts copied into a timeline when a user is followed
+BACKFILL_POSTS_LIMIT = 1000
+
+
+GET_FOLLOWERS_QUERY = '''
+    SELECT follower_id
+    FROM {}
+    WHERE user_id = ?
+    LIMIT ?
+'''
+
+INSERT_ENTRY_QUERY = '''
+    INSERT OR IGNORE INTO {} (entry_id, user_id, post_id, author_id, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+DELETE_AUTHOR_ENTRIES_QUERY = '''
+    DELETE FROM {}
+    WHERE user_id = ?
+    AND author_id = ?
+'''
+
+
+class Timeline(metaclass=MetaRecord):
+    table = 'timelines'
+    primary_key = 'entry_id'
+    schema = (
+        ('entry_id', 'text'),
+        ('user_id', 'text'),
+        ('post_id', 'text'),
+        ('author_id', 'text'),
+        ('timestamp', 'integer'),
+    )
+    indexes = (
+        ('timelines_user_id_timestamp_post_id', ('user_id', 'timestamp DESC', 'post_id DESC'), True),
+        ('timelines_user_id_author_id', ('user_id', 'author_id'), False),
+    )
+
+    def __init__(self, entry_id, user_id, post_id, author_id, timestamp):
+        self.entry_id = entry_id or str(uuid.uuid4())
+        self.user_id = user_id
+        self.post_id = post_id
+        self.author_id = author_id
+        self.timestamp = timestamp
+
+    @classmethod
+    def _insert(cls, cursor, rows):
+        cursor.executemany(
+            INSERT_ENTRY_QUERY.format(Timeline.table),
+            ((str(uuid.uuid4()), user_id, post.post_id, post.user_id, post.timestamp) for user_id, post in rows),
+        )
+
+    @classmethod
+    def fan_out(cls, cursor, post):
+        if Celebrity.exists(cursor, post.user_id):
+            return
+
+        cursor.execute(GET_FOLLOWERS_QUERY.format(Follow.table), (post.user_id, FANOUT_FOLLOWERS_LIMIT + 1))
+        follower_ids = [row[0] for row in cursor.fetchall()]
+        if len(follower_ids) > FANOUT_FOLLOWERS_LIMIT:
+            Celebrity(post.user_id).create_me(cursor)
+            return
+
+        cls._insert(cursor, ((follower_id, post) for follower_id in follower_ids))
+
+    @classmethod
+    def backfill(cls, cursor, user_id, posts):
+        cls._insert(cursor, ((user_id, post) for post in posts))
+
+    @classmethod
+    def prune(cls, cursor, user_id, author_id):
+        cursor.execute(DELETE_AUTHOR_ENTRIES_QUERY.format(Timeline.table), (user_id, author_id))
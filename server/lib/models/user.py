@@ -20,6 +20,12 @@ class User(metaclass=MetaRecord):
         ('password_key', 'text'),
         ('is_admin', 'boolean'),
     )
+    indexes = (
+        ('users_username', ('username',), True),
+    )
+    # Set by the server, other modes read the database directly
+    cache = None
+    cache_keys = ('user_id', 'username')
 
     def __init__(self, user_id, username, password_key, is_admin=False):
         self.user_id = user_id or str(uuid.uuid4())
@@ -29,8 +35,13 @@ class User(metaclass=MetaRecord):
 
     @classmethod
     def read_by_name(cls, cursor, username):
+        cached = cls.read_cached('username', username)
+        if cached is not None:
+            return cached
+
         cursor.execute(READ_BY_NAME_QUERY.format(User.table), (username,))
         res = cursor.fetchone()
         if res is None:
             raise ItemNotFoundError()
-        return cls(*res)
+        cls.cache_row(res)
+        return cls.from_row(res)
@@ -0,0 +1,44 @@
+from lib.cache import LRUCache, cache_version
+from lib.exceptions import ItemNotFoundError
+from lib.transaction import Transaction, READ
+
+from lib.models.user import User
+from lib.models.revoked_token import RevokedToken
+
+
+class RevocationCheck:
+    # Tokens authenticated by their claims are still rejected if the user no longer exists or the token was revoked by signout.
+    # Results are cached per token, so the database is read once per token every ttl seconds
+    def __init__(self, cache_size=10000, ttl=60):
+        self.cache = LRUCache(cache_size, ttl)
+
+    @staticmethod
+    def _key(payload):
+        return payload['user_id'], payload.get('jti')
+
+    def __call__(self, payload):
+        key = self._key(payload)
+        revoked = self.cache.get(key)
+        if revoked is not None:
+            return revoked
+
+        version = cache_version()
+        with Transaction(READ) as tr:
+            try:
+                User.read_by_pk(tr.cursor, payload['user_id'])
+                revoked = 'jti' in payload and RevokedToken.exists(tr.cursor, payload['jti'])
+            except ItemNotFoundError:
+                revoked = True
+
+        # A concurrent signout marks the token revoked after its commit, this result must not overwrite that
+        self.cache.put(key, revoked, version=version)
+        return revoked
+
+    def revoked(self, payload):
+        # Called once the revocation is committed, other processes see it when their cached result expires
+        key = self._key(payload)
+        self.cache.invalidate(key)
+        self.cache.put(key, True)
+
+    def stats(self):
+        return self.cache.stats()
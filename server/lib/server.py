@@ -1,16 +1,59 @@
 import asyncio
+import functools
 import logging
+import random
+import signal
+import time
 
 from lib.auth import AuthHandler
+from lib.batcher import WriteBatcher
 from lib.connection import Connection
-from lib.handlers import Handler
+from lib.counters import LikeCounter
+from lib.exceptions import ServerBusyError
+from lib.executor import Executor
+from lib.hashing import HashPool
+from lib.handlers import Handler, PendingWrite, construct_result
+from lib.metrics import metrics, handle_prometheus_scrape
+from lib.revocation import RevocationCheck
+
+from lib.models.user import User
+
+
+REPORT_INTERVAL = 1
 
 
 class Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, idle_timeout=60, handler_threads=None, max_queue_size=1024, auth_processes=0,
+                 auth_concurrency=None, auth_queue_size=64, pbkdf2_iterations=100000, admin_claim_seconds=300,
+                 stats_interval=0, token_cache_size=10000, like_flush_interval=0, metrics_port=0,
+                 request_log_sample=0, shutdown_timeout=30, reuse_port=False, worker_id=None, reports=None,
+                 write_batch_size=0, write_batch_delay=0.002, max_request_size=1024 * 1024, revocation_ttl=60):
         self._host = host
         self._port = port
-        self.auth_handler = AuthHandler()
+        self.idle_timeout = idle_timeout
+        self.max_request_size = max_request_size
+        self.stats_interval = stats_interval
+        self.executor = Executor(handler_threads, max_queue_size)
+        # Signins may hold at most half of the handler threads, the rest stay free for other requests
+        self.hash_pool = HashPool(auth_processes, auth_concurrency, auth_queue_size, max(1, self.executor.max_workers // 2))
+        self.auth_handler = AuthHandler(
+            pbkdf2_iterations=pbkdf2_iterations,
+            jwt_admin_claim_seconds=admin_claim_seconds,
+            hash_pool=self.hash_pool,
+            token_cache_size=token_cache_size,
+            revocation_check=RevocationCheck(token_cache_size or 1, revocation_ttl),
+        )
+        self.like_flush_interval = like_flush_interval
+        self.like_counter = LikeCounter() if like_flush_interval else None
+        self.write_batcher = WriteBatcher(write_batch_size, write_batch_delay) if write_batch_size > 1 else None
+        self.metrics_port = metrics_port
+        self.request_log_sample = request_log_sample
+        self.shutdown_timeout = shutdown_timeout
+        # Workers of a multi-process server bind the same port with SO_REUSEPORT and report metrics to the supervisor
+        self.reuse_port = reuse_port
+        self.worker_id = worker_id
+        self.reports = reports
+        metrics.add_source('server', self.stats)
 
     @property
     def host(self):
@@ -20,31 +63,155 @@ class Server:
     def port(self):
         return self._port
 
+    def stats(self):
+        return {
+            'executor': self.executor.stats(),
+            'hash_pool': self.hash_pool.stats(),
+            'user_cache': User.cache.stats() if User.cache is not None else None,
+            'token_cache': self.auth_handler.token_cache.stats() if self.auth_handler.token_cache is not None else None,
+            'revocation_cache': self.auth_handler.revocation_check.stats(),
+            'like_counter': self.like_counter.stats() if self.like_counter is not None else None,
+            'write_batcher': self.write_batcher.stats() if self.write_batcher is not None else None,
+        }
+
+    async def log_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            logging.info('Server stats: {}'.format(self.stats()))
+
+    async def flush_likes(self):
+        while True:
+            await asyncio.sleep(self.like_flush_interval)
+            try:
+                await self.executor.run(self.like_counter.flush)
+            except ServerBusyError:
+                logging.warning('Postponing likes flush, server is busy')
+            except Exception as e:
+                logging.exception('Failed to flush likes: {}'.format(e))
+
+    async def report_metrics(self):
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            self.reports.put((self.worker_id, metrics.export_state()))
+
+    async def wait_in_flight(self):
+        deadline = time.monotonic() + self.shutdown_timeout
+        while metrics.in_flight and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if metrics.in_flight:
+            logging.warning('Shutting down with {} requests in flight'.format(metrics.in_flight))
+
     async def handle(self, reader, writer):
         try:
             addr = writer.get_extra_info('peername')
-            logging.info('Incoming request from {}'.format(addr))
+            logging.info('Incoming connection from {}'.format(addr))
+
+            conn = Connection(reader, writer, self.max_request_size)
+            loop = asyncio.get_running_loop()
 
-            conn = Connection(reader, writer)
+            while True:
+                try:
+                    request = await asyncio.wait_for(conn.read(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    logging.info('Closing idle connection from {}'.format(addr))
+                    break
+                except ConnectionError as e:
+                    logging.warning('Closing connection from {}: {}'.format(addr, e))
+                    break
+                except (ValueError, asyncio.LimitOverrunError) as e:
+                    # readline() of a base64 request longer than max_request_size
+                    logging.warning('Closing connection from {}: request is too large ({})'.format(addr, e))
+                    break
 
-            request = await conn.read()
-            response = Handler(self.auth_handler).handle_request(request)
+                if request is None:
+                    break
+
+                started = time.perf_counter()
+                request_id = request.get('request_id') if isinstance(request, dict) else None
+
+                def send_partial(data, request_id=request_id):
+                    # Called from a handler thread, blocks it until the chunk is written to the socket
+                    message = {'code': 200, 'data': data, 'partial': True}
+                    if request_id is not None:
+                        message['request_id'] = request_id
+                    asyncio.run_coroutine_threadsafe(conn.write(message), loop).result()
+
+                handler = Handler(self.auth_handler, send_partial, self.like_counter, self.write_batcher, defer_writes=True)
+                metrics.change_in_flight(1)
+                try:
+                    label = handler.request_label(request)
+                    try:
+                        response = await self.executor.run(handler.handle_request, request)
+                    except ServerBusyError:
+                        response = construct_result(503, 'Server is busy')
+                    if isinstance(response, PendingWrite):
+                        # The handler thread is already free, the commit of the write batch is awaited here
+                        write_batch_started = time.perf_counter()
+                        response = await response.wait()
+                        metrics.observe('write_batch', label, time.perf_counter() - write_batch_started)
+                    if request_id is not None:
+                        response['request_id'] = request_id
+
+                    write_started = time.perf_counter()
+                    await conn.write(response)
+                    finished = time.perf_counter()
+                finally:
+                    metrics.change_in_flight(-1)
+
+                metrics.observe('serialization', label, finished - write_started)
+                metrics.observe('request', label, finished - started)
+                metrics.count_response(label, response.get('code'))
+
+                if self.request_log_sample and random.random() < self.request_log_sample:
+                    logging.info(
+                        'Request %s: code %s, %d bytes in, %d bytes out, %.2f ms',
+                        label, response.get('code'), conn.last_read_size, conn.last_write_size, (finished - started) * 1000,
+                    )
 
-            await conn.write(response)
             await conn.close()
         except KeyboardInterrupt:
             raise
         except Exception as e:
             logging.exception('Unhandled exception occured: {}'.format(e))
+            # The client would otherwise wait for a response that never comes
+            writer.close()
 
     async def loop(self):
-        server = await asyncio.start_server(self.handle, self.host, self.port)
+        # limit bounds base64 request lines the same way max_frame_size bounds binary frames
+        server = await asyncio.start_server(self.handle, self.host, self.port, reuse_port=self.reuse_port, limit=self.max_request_size)
 
         addr = server.sockets[0].getsockname()
         logging.info('Serving on {}'.format(addr))
 
-        async with server:
-            await server.serve_forever()
+        if self.stats_interval:
+            self._stats_task = asyncio.create_task(self.log_stats())
+        if self.like_counter is not None:
+            self._flush_likes_task = asyncio.create_task(self.flush_likes())
+        if self.metrics_port:
+            self._metrics_server = await asyncio.start_server(functools.partial(handle_prometheus_scrape, lambda: metrics), self.host, self.metrics_port)
+            logging.info('Serving metrics on {}'.format(self._metrics_server.sockets[0].getsockname()))
+        if self.reports is not None:
+            self._report_task = asyncio.create_task(self.report_metrics())
+
+        # SIGTERM and SIGINT stop accepting connections and let requests in flight finish,
+        # idle connections are dropped when the loop is torn down
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stopping.set)
+
+        await stopping.wait()
+        logging.info('Shutting down')
+        server.close()
+        await self.wait_in_flight()
 
     def start(self):
-        asyncio.run(self.loop())
+        try:
+            asyncio.run(self.loop())
+        finally:
+            self.executor.shutdown()
+            self.hash_pool.shutdown()
+            if self.write_batcher is not None:
+                self.write_batcher.close()
+            if self.like_counter is not None:
+                self.like_counter.flush()
@@ -0,0 +1,140 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import queue
+import signal
+import time
+
+from lib.metrics import Metrics, handle_prometheus_scrape, sum_stats
+
+
+SUPERVISE_INTERVAL = 0.5
+# Workers dying sooner than this after start are restarted with a delay, so a broken setup does not spin
+MIN_WORKER_UPTIME = 5
+RESTART_DELAY = 5
+
+
+class Worker:
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.process = None
+        self.started = None
+        self.restart_at = 0
+        self.restarts = 0
+
+
+class Supervisor:
+    def __init__(self, target, args, workers, host='127.0.0.1', stats_interval=0, metrics_port=0, shutdown_timeout=30):
+        self.target = target
+        self.args = args
+        self.host = host
+        self.stats_interval = stats_interval
+        self.metrics_port = metrics_port
+        self.shutdown_timeout = shutdown_timeout
+
+        # Spawned rather than forked, the same way as the password hashing pool, so workers start from a clean state
+        self.context = multiprocessing.get_context('spawn')
+        self.reports = self.context.Queue()
+        self.workers = [Worker(worker_id) for worker_id in range(workers)]
+        self.states = {}
+
+    def start_worker(self, worker):
+        worker.process = self.context.Process(
+            target=self.target,
+            args=(self.args, worker.worker_id, self.reports),
+            name='worker-{}'.format(worker.worker_id),
+        )
+        worker.process.start()
+        worker.started = time.monotonic()
+        logging.info('Started worker {} with pid {}'.format(worker.worker_id, worker.process.pid))
+
+    def check_worker(self, worker):
+        now = time.monotonic()
+        if worker.process is not None:
+            if worker.process.is_alive():
+                return
+
+            logging.error('Worker {} exited with code {}'.format(worker.worker_id, worker.process.exitcode))
+            worker.process = None
+            self.states.pop(worker.worker_id, None)
+            worker.restarts += 1
+            worker.restart_at = now + (RESTART_DELAY if now - worker.started < MIN_WORKER_UPTIME else 0)
+
+        if now >= worker.restart_at:
+            self.start_worker(worker)
+
+    def collect_reports(self):
+        while True:
+            try:
+                worker_id, state = self.reports.get_nowait()
+            except queue.Empty:
+                return
+            self.states[worker_id] = state
+
+    def aggregate(self):
+        total = Metrics()
+        states = list(self.states.values())
+        for state in states:
+            total.merge_state(state)
+
+        total.add_source('server', lambda: sum_stats(state['sources'].get('server') for state in states))
+        total.add_source('workers', self.stats)
+        return total
+
+    def stats(self):
+        return {
+            'workers': len(self.workers),
+            'alive': sum(1 for worker in self.workers if worker.process is not None and worker.process.is_alive()),
+            'reporting': len(self.states),
+            'restarts': sum(worker.restarts for worker in self.workers),
+        }
+
+    async def log_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            logging.info('Server stats: {}'.format(self.aggregate().snapshot()))
+
+    async def loop(self):
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stopping.set)
+
+        if self.stats_interval:
+            self._stats_task = asyncio.create_task(self.log_stats())
+        if self.metrics_port:
+            self._metrics_server = await asyncio.start_server(functools.partial(handle_prometheus_scrape, self.aggregate), self.host, self.metrics_port)
+            logging.info('Serving metrics on {}'.format(self._metrics_server.sockets[0].getsockname()))
+
+        while not stopping.is_set():
+            for worker in self.workers:
+                self.check_worker(worker)
+            self.collect_reports()
+            try:
+                await asyncio.wait_for(stopping.wait(), SUPERVISE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+        logging.info('Shutting down workers')
+
+    def shutdown(self):
+        processes = [worker.process for worker in self.workers if worker.process is not None]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+        # Workers finish requests in flight within their own shutdown timeout, this one is a safety net on top of it
+        deadline = time.monotonic() + self.shutdown_timeout + 5
+        for process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning('Killing worker with pid {}'.format(process.pid))
+                process.kill()
+                process.join()
+
+    def start(self):
+        try:
+            asyncio.run(self.loop())
+        finally:
+            self.shutdown()
@@ -1,18 +1,124 @@
 import sqlite3
+import threading
+import time
+
+from lib.cache import cache_version
+from lib.metrics import metrics
+
+
+READ = 'DEFERRED'
+WRITE = 'IMMEDIATE'
+EXCLUSIVE = 'EXCLUSIVE'
+
+
+class ConnectionPool:
+    def __init__(self, path='small_twitter.db', timeout=5, cached_statements=256,
+                 pragmas=('cache_size = -16000', 'temp_store = MEMORY')):
+        self.path = path
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.pragmas = pragmas
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.timeout,
+                isolation_level=None,
+                cached_statements=self.cached_statements,
+                check_same_thread=False,
+            )
+            for pragma in self.pragmas:
+                conn.execute('PRAGMA {}'.format(pragma))
+
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+        self._local = threading.local()
+
+
+pool = ConnectionPool()
+
+
+def configure_pool(path, journal_mode='WAL', **kwargs):
+    global pool
+    pool.close()
+    pool = ConnectionPool(path, **kwargs)
+    # journal_mode is stored in the database file, so it is enough to set it once per process
+    pool.connection().execute('PRAGMA journal_mode = {}'.format(journal_mode))
+
+
+_current = threading.local()
+
+
+def current_cache_version():
+    # Version taken before the snapshot of the current thread's transaction, None outside of a transaction
+    transaction = getattr(_current, 'transaction', None)
+    return transaction.cache_version if transaction is not None else None
+
+
+def after_transaction(func):
+    # Runs func once the transaction of the current thread is over, or right away outside of a transaction
+    transaction = getattr(_current, 'transaction', None)
+    if transaction is None:
+        func()
+    else:
+        transaction.callbacks.append(func)
 
 
 class Transaction:
+    def __init__(self, mode=WRITE):
+        self.mode = mode
+        self.callbacks = []
+
     @property
     def cursor(self):
         return self._cursor
 
     def __enter__(self):
-        self._conn = sqlite3.connect('small_twitter.db', timeout=5, isolation_level=None)
-        self._conn.__enter__()
-        self._conn.execute('BEGIN EXCLUSIVE TRANSACTION')
+        self._started = time.perf_counter()
+        # Taken before BEGIN: a row read by any statement of the transaction is at least as new as this version
+        self.cache_version = cache_version()
+        self._conn = pool.connection()
+        self._conn.execute('BEGIN {} TRANSACTION'.format(self.mode))
+        # BEGIN IMMEDIATE and EXCLUSIVE block on the database lock, so this is mostly time spent waiting for other writers
+        metrics.add('lock_wait', time.perf_counter() - self._started)
         self._cursor = self._conn.cursor()
+        _current.transaction = self
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self._conn.execute('COMMIT TRANSACTION')
-        self._conn.__exit__(exc_type, exc_value, traceback)
+        self._cursor.close()
+        try:
+            if exc_type is None:
+                try:
+                    self._conn.execute('COMMIT TRANSACTION')
+                except Exception:
+                    # The connection outlives the transaction, so it must not be left inside it (e.g. after "database is locked")
+                    self._rollback()
+                    raise
+            else:
+                self._rollback()
+        finally:
+            metrics.add('db', time.perf_counter() - self._started)
+            _current.transaction = None
+            callbacks, self.callbacks = self.callbacks, []
+            for func in callbacks:
+                func()
+
+    def _rollback(self):
+        # SQLite may already have rolled back on its own (e.g. on SQLITE_FULL), then ROLLBACK would fail and hide the original error
+        if self._conn.in_transaction:
+            self._conn.execute('ROLLBACK TRANSACTION')